@@ -0,0 +1,56 @@
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+
+class AvatarCache:
+    # Per-user prepared avatars (or None for users without one), with TTL + LRU eviction
+    def __init__(self, ttl: float = 3600.0, max_entries: int = 2048):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._items: OrderedDict[int, tuple[float, Optional[bytes]]] = OrderedDict()
+        self._inflight: dict[int, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._items), "inflight": len(self._inflight)}
+
+    def invalidate(self, user_id: int) -> None:
+        self._items.pop(user_id, None)
+
+    async def get(self, user_id: int, fetch: Callable[[], Awaitable[Optional[bytes]]]) -> Optional[bytes]:
+        entry = self._items.get(user_id)
+        if entry is not None:
+            expires_at, avatar = entry
+            if expires_at > time.monotonic():
+                self._items.move_to_end(user_id)
+                self.hits += 1
+                return avatar
+            del self._items[user_id]
+
+        inflight = self._inflight.get(user_id)
+        if inflight is not None:
+            self.hits += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[user_id] = future
+        try:
+            avatar = await fetch()
+        except BaseException as e:
+            # Waiters only expect ordinary errors, even if the owning handler got cancelled
+            future.set_exception(e if isinstance(e, Exception) else RuntimeError("avatar fetch cancelled"))
+            # Mark retrieved so a failure with no other waiters doesn't log "exception never retrieved"
+            future.exception()
+            raise
+        else:
+            future.set_result(avatar)
+            self._items[user_id] = (time.monotonic() + self.ttl, avatar)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+            return avatar
+        finally:
+            del self._inflight[user_id]
@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import statistics
+import tracemalloc
+from io import BytesIO
+from PIL import Image
+from image_generator import (
+    create_quote_image, compute_layout, get_wrapped_lines, make_circle, prepare_avatar,
+    render_multi_quote, get_fonts, warm_fonts, THEMES, AVATAR_SIZE,
+)
+from image_encoder import encode_image, OUTPUT_FORMATS
+
+BASELINE_FILE = "bench_baseline.json"
+TIME_TEXT = "12:34"
+
+
+def make_avatar_bytes(size: int = 640) -> bytes:
+    # Deterministic gradient so JPEG decode/resize cost resembles a real profile photo
+    img = Image.linear_gradient("L").resize((size, size)).convert("RGB")
+    output = BytesIO()
+    img.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+def build_cases(avatar_bytes: bytes) -> dict:
+    texts = {
+        "short": "This is a test quote.",
+        "long": " ".join(["the quick brown fox jumps over the lazy dog"] * 60),
+        "newlines": "\n".join(f"line {i}" if i % 3 else "" for i in range(60)),
+        "non_latin": "Привет, как дела? 你好，世界！ مرحبا بالعالم こんにちは 🙂🔥 " * 8,
+    }
+    cases = {}
+    for text_name, text in texts.items():
+        cases[f"{text_name}/letter"] = (None, "Test Name", text, "default")
+        cases[f"{text_name}/avatar"] = (avatar_bytes, "Test Name", text, "default")
+    for theme in THEMES:
+        cases[f"theme_{theme}/avatar"] = (avatar_bytes, "Test Name", texts["short"], theme)
+    return cases
+
+
+def time_call(fn, repeat: int) -> list[float]:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def summarize(samples: list[float]) -> dict:
+    ordered = sorted(samples)
+    return {
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+    }
+
+
+def bench_case(args: tuple, repeat: int) -> dict:
+    avatar_bytes, name, text, theme = args
+    font_text = get_fonts()[0]
+    png = create_quote_image(avatar_bytes, name, text, theme, TIME_TEXT).getvalue()
+    rendered = render_multi_quote([{"avatar": avatar_bytes, "name": name, "text": text, "time_text": TIME_TEXT}], theme)
+
+    stages = {
+        "wrap": time_call(lambda: get_wrapped_lines(text, font_text, 800), repeat),
+        "layout": time_call(lambda: compute_layout(name, text, TIME_TEXT), repeat),
+        "encode": time_call(lambda: rendered.save(BytesIO(), format="PNG"), repeat),
+        "total": time_call(lambda: create_quote_image(avatar_bytes, name, text, theme, TIME_TEXT), repeat),
+    }
+    if avatar_bytes:
+        decoded = Image.open(BytesIO(avatar_bytes)).convert("RGB")
+        stages["make_circle"] = time_call(lambda: make_circle(decoded, AVATAR_SIZE), repeat)
+        stages["prepare_avatar"] = time_call(lambda: prepare_avatar(avatar_bytes), repeat)
+
+    tracemalloc.start()
+    create_quote_image(avatar_bytes, name, text, theme, TIME_TEXT)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {stage: summarize(samples) for stage, samples in stages.items()}
+    result["formats"] = {
+        fmt: {"bytes": len(encode_image(rendered, fmt)), "encode": summarize(time_call(lambda: encode_image(rendered, fmt), repeat))}
+        for fmt in OUTPUT_FORMATS
+    }
+    result["quotes_per_sec"] = 1000 / result["total"]["mean_ms"]
+    result["py_peak_kb"] = peak / 1024
+    result["png_bytes"] = len(png)
+    return result
+
+
+def run(repeat: int, only: str = "") -> dict:
+    warm_fonts()
+    cases = build_cases(make_avatar_bytes())
+    results = {}
+    for case_name, args in cases.items():
+        if only and only not in case_name:
+            continue
+        results[case_name] = bench_case(args, repeat)
+    return {
+        "python": platform.python_version(),
+        "pillow": Image.__version__,
+        "repeat": repeat,
+        # ru_maxrss is KiB on Linux
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "cases": results,
+    }
+
+
+def print_report(report: dict) -> None:
+    print(f"Python {report['python']}, Pillow {report['pillow']}, {report['repeat']} runs per stage, max RSS {report['max_rss_kb'] / 1024:.1f} MiB")
+    header = f"{'case':<24}{'total ms':>10}{'p95 ms':>9}{'q/s':>8}{'wrap':>8}{'layout':>8}{'encode':>8}{'avatar':>8}{'py KiB':>9}{'PNG B':>9}"
+    print(header)
+    print("-" * len(header))
+    for case_name, r in report["cases"].items():
+        avatar = r.get("prepare_avatar", {}).get("mean_ms", 0.0)
+        print(f"{case_name:<24}{r['total']['mean_ms']:>10.2f}{r['total']['p95_ms']:>9.2f}{r['quotes_per_sec']:>8.1f}"
+              f"{r['wrap']['mean_ms']:>8.2f}{r['layout']['mean_ms']:>8.2f}{r['encode']['mean_ms']:>8.2f}{avatar:>8.2f}"
+              f"{r['py_peak_kb']:>9.0f}{r['png_bytes']:>9}")
+
+    print(f"\nOutput formats (bytes / mean encode ms):")
+    header = f"{'case':<24}" + "".join(f"{fmt:>20}" for fmt in OUTPUT_FORMATS)
+    print(header)
+    print("-" * len(header))
+    for case_name, r in report["cases"].items():
+        cells = "".join(f"{f['bytes']:>11} /{f['encode']['mean_ms']:>6.1f}" for f in r["formats"].values())
+        print(f"{case_name:<24}{cells}")
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+    for case_name, r in report["cases"].items():
+        base = baseline["cases"].get(case_name)
+        if not base:
+            continue
+        for stage, stats in r.items():
+            if not isinstance(stats, dict) or "p50_ms" not in stats or stage not in base:
+                continue
+            # Medians are far less sensitive to a noisy neighbour than means
+            old, new = base[stage]["p50_ms"], stats["p50_ms"]
+            if old > 0 and (new - old) / old > threshold:
+                regressions.append(f"{case_name} {stage}: {old:.2f} ms -> {new:.2f} ms (+{(new - old) / old:.0%})")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the quote image rendering pipeline (no network needed).")
+    parser.add_argument("-n", "--repeat", type=int, default=20, help="runs per stage and case")
+    parser.add_argument("-k", "--only", default="", help="only run cases whose name contains this string")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline JSON to compare against / save to")
+    parser.add_argument("--save-baseline", action="store_true", help="write this run as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown vs baseline before failing (0.2 = 20%%)")
+    parser.add_argument("--json", help="also write the full report to this file")
+    args = parser.parse_args()
+
+    report = run(args.repeat, args.only)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+        print(f"\nSaved baseline to {args.baseline}")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%} vs {args.baseline}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nNo regressions over {args.threshold:.0%} vs {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """You keep a running summary of a Telegram group chat for a chatbot.
+Rewrite the summary so it also covers the new messages. Keep names, running jokes, who said what to whom,
+and anything the bot promised or was asked. Plain text, at most {words} words, no preamble.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}
+
+Updated summary:"""
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for budgeting and needs no tokenizer
+    return len(text) // 4 + 1
+
+
+class Turn:
+    __slots__ = ("message_id", "speaker", "text", "tokens")
+
+    def __init__(self, message_id: Optional[int], speaker: str, text: str, tokens: int):
+        self.message_id = message_id
+        self.speaker = speaker
+        self.text = text
+        self.tokens = tokens
+
+    def line(self) -> str:
+        return f"{self.speaker}: {self.text}"
+
+
+class ChatMemory:
+    __slots__ = ("turns", "tokens", "summary", "overflow", "overflow_tokens", "last_active", "summarizing",
+                 "failures", "retry_at", "engaged_until")
+
+    def __init__(self):
+        self.turns: deque[Turn] = deque()
+        self.tokens = 0
+        self.summary = ""
+        # Turns pushed out of the window that the summary doesn't cover yet
+        self.overflow: deque[Turn] = deque()
+        self.overflow_tokens = 0
+        self.last_active = time.monotonic()
+        self.summarizing = False
+        # Consecutive failed summaries, and when to try again after the last one
+        self.failures = 0
+        self.retry_at = 0.0
+        # Summaries are only made while the bot is being talked to here
+        self.engaged_until = 0.0
+
+
+class ChatMemoryStore:
+    """Recent turns per chat within a token budget; older turns are folded into a rolling summary.
+
+    The prompt context is bounded by token_budget + summary_tokens no matter how busy the chat is.
+    Summaries are produced in the background as turns fall out of the window, never on a reply's critical path,
+    and only for chats where the bot was engaged within `engaged_ttl`; other chats just keep their recent turns.
+    `summarize(chat_id, prompt)` returns None when it skipped the call (rate limited, LLM busy), which is retried
+    later without counting as a failure. Fallen-out turns of an engaged chat are only dropped unsummarized when
+    there is no summarizer or it keeps failing.
+    """
+
+    def __init__(self, summarize: Optional[Callable[[int, str], Awaitable[Optional[str]]]] = None, max_turns: int = 30,
+                 token_budget: int = 600, summary_tokens: int = 150, turn_tokens: int = 120,
+                 idle_ttl: float = 6 * 3600, max_chats: int = 10000, max_backlog_tokens: Optional[int] = None,
+                 max_failures: int = 3, retry_delay: float = 30.0, engaged_ttl: float = 1800.0):
+        self.summarize = summarize
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.turn_tokens = turn_tokens
+        self.idle_ttl = idle_ttl
+        self.max_chats = max_chats
+        # Room for turns that pile up while a summary is in flight; bounds memory if the summarizer hangs
+        self.max_backlog_tokens = max_backlog_tokens if max_backlog_tokens is not None else token_budget * 8
+        self.max_failures = max_failures
+        self.retry_delay = retry_delay
+        self.engaged_ttl = engaged_ttl
+        # Least recently active chat first, so idle eviction only ever looks at the front
+        self._chats: OrderedDict[int, ChatMemory] = OrderedDict()
+        self._tasks: set[asyncio.Task] = set()
+        self.summaries = 0
+        self.summary_failures = 0
+        self.summaries_skipped = 0
+        self.dropped_turns = 0
+        self.evicted_chats = 0
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self._chats),
+            "summaries": self.summaries,
+            "summary_failures": self.summary_failures,
+            "summaries_skipped": self.summaries_skipped,
+            "dropped_turns": self.dropped_turns,
+            "evicted_chats": self.evicted_chats,
+        }
+
+    def _evict_idle(self, now: float) -> None:
+        while self._chats:
+            chat_id, memory = next(iter(self._chats.items()))
+            if len(self._chats) <= self.max_chats and now - memory.last_active < self.idle_ttl:
+                break
+            del self._chats[chat_id]
+            self.evicted_chats += 1
+
+    def engage(self, chat_id: int) -> None:
+        # Called when someone talks to the bot; from then on this chat's fallen-out turns get summarized
+        memory = self._chats.get(chat_id)
+        if memory is None:
+            memory = self._chats[chat_id] = ChatMemory()
+        memory.engaged_until = time.monotonic() + self.engaged_ttl
+
+    def add(self, chat_id: int, speaker: str, text: str, message_id: Optional[int] = None) -> None:
+        now = time.monotonic()
+        memory = self._chats.get(chat_id)
+        if memory is None:
+            memory = self._chats[chat_id] = ChatMemory()
+        else:
+            self._chats.move_to_end(chat_id)
+        memory.last_active = now
+
+        # Long messages are clipped so one wall of text can't push the whole conversation out
+        max_chars = self.turn_tokens * 4
+        if len(text) > max_chars:
+            text = text[:max_chars - 1] + "…"
+        turn = Turn(message_id, speaker, text, estimate_tokens(speaker) + estimate_tokens(text))
+        memory.turns.append(turn)
+        memory.tokens += turn.tokens
+
+        while memory.turns and (memory.tokens > self.token_budget or len(memory.turns) > self.max_turns):
+            old = memory.turns.popleft()
+            memory.tokens -= old.tokens
+            memory.overflow.append(old)
+            memory.overflow_tokens += old.tokens
+        # Without a working summarizer, or in a chat that isn't talking to the bot, nothing will fold the backlog
+        # in, so only keep a budget's worth of it
+        if self.summarize is None or memory.failures >= self.max_failures or now >= memory.engaged_until:
+            cap = self.token_budget
+        else:
+            cap = self.max_backlog_tokens
+        while memory.overflow_tokens > cap:
+            old = memory.overflow.popleft()
+            memory.overflow_tokens -= old.tokens
+            self.dropped_turns += 1
+
+        self._evict_idle(now)
+        self.maybe_summarize(chat_id)
+
+    def context(self, chat_id: int, exclude_message_id: Optional[int] = None) -> tuple[str, str]:
+        """Returns (summary, recent turns as "Name: text" lines)."""
+        memory = self._chats.get(chat_id)
+        if memory is None:
+            return "", ""
+        lines = [turn.line() for turn in memory.turns if exclude_message_id is None or turn.message_id != exclude_message_id]
+        return memory.summary, "\n".join(lines)
+
+    def maybe_summarize(self, chat_id: int) -> None:
+        # Batch the backlog: one LLM call per half a budget of fallen-out turns, and one at a time per chat
+        memory = self._chats.get(chat_id)
+        now = time.monotonic()
+        if (self.summarize is None or memory is None or memory.summarizing or now >= memory.engaged_until
+                or memory.overflow_tokens < self.token_budget // 2 or now < memory.retry_at):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        memory.summarizing = True
+        task = loop.create_task(self._summarize(chat_id, memory))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _summarize(self, chat_id: int, memory: ChatMemory) -> None:
+        batch = list(memory.overflow)
+        prompt = SUMMARY_PROMPT.format(
+            words=self.summary_tokens * 3 // 4,
+            summary=memory.summary or "(nothing yet)",
+            messages="\n".join(turn.line() for turn in batch),
+        )
+        try:
+            summary = await self.summarize(chat_id, prompt)
+            if summary is None:
+                self.summaries_skipped += 1
+                memory.retry_at = time.monotonic() + self.retry_delay
+                return
+            summary = summary.strip()
+            if not summary:
+                raise ValueError("empty summary")
+        except Exception as e:
+            self.summary_failures += 1
+            memory.failures += 1
+            # Back off so a failing LLM isn't asked again on every new message
+            memory.retry_at = time.monotonic() + self.retry_delay * min(2 ** (memory.failures - 1), 32)
+            logger.error(f"Chat summary failed: {e}")
+            return
+        finally:
+            memory.summarizing = False
+        memory.failures = 0
+        memory.retry_at = 0.0
+
+        max_chars = self.summary_tokens * 4
+        memory.summary = summary if len(summary) <= max_chars else summary[:max_chars - 1] + "…"
+        # Only drop what this summary covered; turns that overflowed meanwhile wait for the next one
+        covered = {id(turn) for turn in batch}
+        while memory.overflow and id(memory.overflow[0]) in covered:
+            old = memory.overflow.popleft()
+            memory.overflow_tokens -= old.tokens
+        self.summaries += 1
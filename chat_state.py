@@ -0,0 +1,210 @@
+import sqlite3
+import asyncio
+import logging
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHARACTER = "genz"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_settings (
+    chat_id TEXT PRIMARY KEY,
+    character TEXT,
+    quote_format TEXT,
+    seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chat_settings_seq ON chat_settings (seq);
+CREATE TABLE IF NOT EXISTS chat_vips (
+    chat_id TEXT NOT NULL,
+    username TEXT NOT NULL,
+    PRIMARY KEY (chat_id, username)
+);
+"""
+
+
+class ChatState:
+    __slots__ = ("character", "quote_format", "vips")
+
+    def __init__(self, character: str = DEFAULT_CHARACTER, quote_format: Optional[str] = None, vips=()):
+        self.character = character
+        self.quote_format = quote_format
+        self.vips = set(vips)
+
+
+class ChatStateStore:
+    """Per-chat settings served from memory, written behind to SQLite.
+
+    Reads never touch disk: every row is loaded at startup and changes made by other
+    processes are picked up by refresh(). Scalars are last-writer-wins; VIP additions and
+    removals are applied as individual rows so concurrent writers don't clobber each other.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        # _lock guards the in-memory state and is only ever held briefly, so setters on the event loop never wait
+        # on SQLite; _db_lock serializes use of the connection by flush() and refresh() in worker threads
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._states: dict[int, ChatState] = {}
+        # Pending writes: chats whose scalars changed, and VIP (chat_id, username, added) ops in order
+        self._dirty: set[int] = set()
+        self._vip_ops: list[tuple[int, str, bool]] = []
+        self._seq = 0
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.refreshed = 0
+        self._apply(*self._fetch(None))
+
+    def get(self, chat_id: int) -> ChatState:
+        state = self._states.get(chat_id)
+        if state is None:
+            state = self._states[chat_id] = ChatState()
+        return state
+
+    def set_character(self, chat_id: int, character: str) -> None:
+        with self._lock:
+            self.get(chat_id).character = character
+            self._dirty.add(chat_id)
+
+    def set_quote_format(self, chat_id: int, quote_format: str) -> None:
+        with self._lock:
+            self.get(chat_id).quote_format = quote_format
+            self._dirty.add(chat_id)
+
+    def add_vip(self, chat_id: int, username: str) -> None:
+        with self._lock:
+            self.get(chat_id).vips.add(username)
+            self._vip_ops.append((chat_id, username, True))
+
+    def remove_vip(self, chat_id: int, username: str) -> bool:
+        with self._lock:
+            vips = self.get(chat_id).vips
+            if username not in vips:
+                return False
+            vips.discard(username)
+            self._vip_ops.append((chat_id, username, False))
+            return True
+
+    def _fetch(self, chat_ids: Optional[list[str]]) -> tuple[list, list]:
+        # Caller holds _db_lock (or we're in __init__); chat_ids=None loads everything
+        if chat_ids is None:
+            settings = self._conn.execute("SELECT chat_id, character, quote_format, seq FROM chat_settings").fetchall()
+            vips = self._conn.execute("SELECT chat_id, username FROM chat_vips").fetchall()
+        else:
+            marks = ",".join("?" * len(chat_ids))
+            settings = self._conn.execute(
+                f"SELECT chat_id, character, quote_format, seq FROM chat_settings WHERE chat_id IN ({marks})", chat_ids
+            ).fetchall()
+            vips = self._conn.execute(f"SELECT chat_id, username FROM chat_vips WHERE chat_id IN ({marks})", chat_ids).fetchall()
+        return settings, vips
+
+    def _apply(self, settings: list, vips: list) -> None:
+        # Caller holds _lock (or we're in __init__)
+        by_chat: dict[int, set] = {}
+        for chat_id, username in vips:
+            by_chat.setdefault(int(chat_id), set()).add(username)
+        for chat_id, character, quote_format, seq in settings:
+            chat_id = int(chat_id)
+            self._seq = max(self._seq, seq)
+            # Local changes that haven't been flushed yet win over what's on disk
+            if chat_id in self._dirty or any(op[0] == chat_id for op in self._vip_ops):
+                continue
+            self._states[chat_id] = ChatState(character or DEFAULT_CHARACTER, quote_format, by_chat.get(chat_id, ()))
+
+    def flush(self) -> int:
+        with self._db_lock:
+            with self._lock:
+                if not self._dirty and not self._vip_ops:
+                    return 0
+                dirty, self._dirty = self._dirty, set()
+                vip_ops, self._vip_ops = self._vip_ops, []
+                settings = [(str(c), self._states[c].character, self._states[c].quote_format) for c in dirty]
+            touched = {str(c) for c in dirty} | {str(op[0]) for op in vip_ops}
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM chat_settings").fetchone()[0]
+                for chat_id, character, quote_format in settings:
+                    self._conn.execute(
+                        "INSERT INTO chat_settings (chat_id, character, quote_format, seq) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(chat_id) DO UPDATE SET character = excluded.character, "
+                        "quote_format = excluded.quote_format, seq = excluded.seq",
+                        (chat_id, character, quote_format, seq),
+                    )
+                for chat_id, username, added in vip_ops:
+                    if added:
+                        self._conn.execute("INSERT OR IGNORE INTO chat_vips (chat_id, username) VALUES (?, ?)", (str(chat_id), username))
+                    else:
+                        self._conn.execute("DELETE FROM chat_vips WHERE chat_id = ? AND username = ?", (str(chat_id), username))
+                # Bump seq on every touched chat so other processes notice VIP-only changes too
+                for chat_id in touched:
+                    self._conn.execute(
+                        "INSERT INTO chat_settings (chat_id, seq) VALUES (?, ?) ON CONFLICT(chat_id) DO UPDATE SET seq = excluded.seq",
+                        (chat_id, seq),
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                # Put the writes back so the next flush retries them, ahead of anything queued meanwhile
+                with self._lock:
+                    self._dirty |= dirty
+                    self._vip_ops[:0] = vip_ops
+                # BEGIN itself fails when another process holds the write lock past the busy timeout
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                raise
+            self.flushes += 1
+            return len(touched)
+
+    def refresh(self) -> int:
+        # Pull in rows other processes changed since we last looked
+        with self._db_lock:
+            changed = [row[0] for row in self._conn.execute("SELECT chat_id FROM chat_settings WHERE seq > ?", (self._seq,))]
+            if not changed:
+                return 0
+            rows = self._fetch(changed)
+            with self._lock:
+                self._apply(*rows)
+            self.refreshed += len(changed)
+            return len(changed)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await asyncio.to_thread(self.flush)
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                logger.error(f"Chat state sync failed: {e}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+
+    def close(self) -> None:
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self._states),
+            "pending": len(self._dirty) + len(self._vip_ops),
+            "flushes": self.flushes,
+            "refreshed": self.refreshed,
+        }
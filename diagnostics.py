@@ -0,0 +1,225 @@
+import io
+import os
+import sys
+import time
+import pstats
+import asyncio
+import cProfile
+import logging
+import threading
+import tracemalloc
+from collections import Counter, deque
+from typing import Optional
+from metrics import counter, histogram
+
+logger = logging.getLogger(__name__)
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Our own rendering and storage code, for the focused section of profile reports
+FOCUS_PATTERN = r"(main|image_generator|image_encoder|render_pool|render_cache|quote_store|chat_state|chat_memory)\.py"
+
+LOOP_LAG = histogram(
+    "bot_loop_lag_seconds", "How late the event loop ran a scheduled heartbeat",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+LOOP_STALLS = counter("bot_loop_stalls_total", "Times something blocked the event loop past the stall threshold")
+
+
+def _own_frame(filename: str) -> bool:
+    return filename.startswith(SOURCE_DIR) and "site-packages" not in filename
+
+
+class LoopWatchdog:
+    """Measures event-loop lag and catches whatever blocks the loop.
+
+    A heartbeat on the loop stamps the time every `interval`. A separate thread checks the stamp, and once it is
+    more than `threshold` stale it samples the loop thread's stack every `sample_interval` until the loop comes
+    back. The most frequent stack is logged and kept, along with the handler and innermost line of our own code in it.
+    """
+
+    def __init__(self, threshold: float = 0.25, interval: float = 0.05, sample_interval: float = 0.01, max_stalls: int = 20):
+        self.threshold = threshold
+        self.interval = interval
+        self.sample_interval = sample_interval
+        self.stalls: deque = deque(maxlen=max_stalls)
+        self.max_lag = 0.0
+        self._beat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def stats(self) -> dict:
+        return {"stalls": LOOP_STALLS.value(), "max_lag_seconds": self.max_lag}
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+
+    async def _heartbeat(self) -> None:
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - start - self.interval)
+            self._beat = now
+            LOOP_LAG.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    def _watch(self) -> None:
+        samples: Counter = Counter()
+        stalled_since = None
+        while not self._stop.wait(self.sample_interval):
+            beat = self._beat
+            if time.monotonic() - beat < self.interval + self.threshold:
+                if samples:
+                    self._record_stall(samples, max(0.0, beat - stalled_since - self.interval))
+                    samples = Counter()
+                continue
+            stalled_since = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, frame.f_lineno, code.co_name))
+                frame = frame.f_back
+            # Outermost first, like a traceback
+            samples[tuple(reversed(stack))] += 1
+
+    def _record_stall(self, samples: Counter, blocked: float) -> None:
+        stack, hits = samples.most_common(1)[0]
+        where = lambda f: f"{os.path.basename(f[0])}:{f[1]} {f[2]}"
+        # The innermost run of our own frames: its outermost frame is the handler the library called into
+        own = [i for i, f in enumerate(stack) if _own_frame(f[0])]
+        handler = hot_spot = None
+        if own:
+            first = last = own[-1]
+            while first > 0 and _own_frame(stack[first - 1][0]):
+                first -= 1
+            handler, hot_spot = stack[first], stack[last]
+        stall = {
+            "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "blocked_ms": round(blocked * 1000),
+            "samples": sum(samples.values()),
+            "top_stack_share": round(hits / sum(samples.values()), 2),
+            "handler": where(handler) if handler else "?",
+            "hot_spot": where(hot_spot) if hot_spot else where(stack[-1]),
+            "stack": [where(f) for f in stack[-25:]],
+        }
+        self.stalls.append(stall)
+        LOOP_STALLS.inc()
+        logger.warning(
+            f"Event loop blocked for {stall['blocked_ms']}ms in {stall['handler']} at {stall['hot_spot']}\n  "
+            + "\n  ".join(stall["stack"])
+        )
+
+
+_profiling = False
+
+
+def profiling() -> bool:
+    return _profiling
+
+
+class _RawStats:
+    # What pstats.Stats accepts in place of a Profile: anything with create_stats() and a .stats dict
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self) -> None:
+        pass
+
+
+async def profile_for(seconds: float, out_dir: str, top: int = 30, render_pool=None) -> tuple[str, str]:
+    """Profiles the event-loop thread (cProfile) and its allocations (tracemalloc) for `seconds`.
+
+    With `render_pool`, every render that runs in the window is also profiled inside its pool worker (process
+    or thread) and the merged result is reported and saved next to the loop profile as *-render.prof; without
+    it, rendering only shows up as time awaiting the pool. Allocations are only tracked on the loop's process.
+    Returns the text report and the path of the loop's .prof file (open either with snakeviz or pstats).
+    """
+    global _profiling
+    if _profiling:
+        raise RuntimeError("a profile is already running")
+    _profiling = True
+    profiler = cProfile.Profile()
+    own_tracemalloc = not tracemalloc.is_tracing()
+    renders: list[dict] = []
+    try:
+        if own_tracemalloc:
+            tracemalloc.start(10)
+        before = tracemalloc.take_snapshot()
+        if render_pool is not None:
+            render_pool.start_profiling()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            if render_pool is not None:
+                renders = render_pool.stop_profiling()
+        after = tracemalloc.take_snapshot()
+    finally:
+        if own_tracemalloc:
+            tracemalloc.stop()
+        _profiling = False
+
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.prof")
+    profiler.dump_stats(path)
+
+    out = io.StringIO()
+    out.write(f"Event loop profile, pid {os.getpid()}, {seconds:g}s\n")
+    if render_pool is not None:
+        out.write(f"\n== Render workers ({render_pool.kind}), {len(renders)} renders, by cumulative time ==\n")
+        if renders:
+            render_stats = pstats.Stats(_RawStats(renders[0]), stream=out)
+            for stats in renders[1:]:
+                render_stats.add(_RawStats(stats))
+            render_stats.dump_stats(path[:-len(".prof")] + "-render.prof")
+            render_stats.sort_stats("cumulative").print_stats(top)
+        else:
+            out.write("No renders finished during the window.\n")
+    out.write("\n== Loop thread: rendering and storage code, by cumulative time ==\n")
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(FOCUS_PATTERN, top)
+    out.write("\n== Loop thread: everything, by own time ==\n")
+    pstats.Stats(profiler, stream=out).sort_stats("tottime").print_stats(top)
+    out.write("\n== Memory allocated during the window, by line ==\n")
+    for stat in after.compare_to(before, "lineno")[:top]:
+        out.write(f"{stat}\n")
+    report = out.getvalue()
+    with open(path[:-len(".prof")] + ".txt", "w", encoding="utf-8") as f:
+        f.write(report)
+    return report, path
+
+
+def prune_profiles(out_dir: str, keep: int = 20) -> None:
+    try:
+        names = [n for n in os.listdir(out_dir) if n.startswith("profile-")]
+    except FileNotFoundError:
+        return
+    # Each profile is a .prof/.txt pair, plus -render.prof when the pool was profiled; they share a stem
+    stem = lambda name: name.split(".")[0].removesuffix("-render")
+    stale = sorted({stem(n) for n in names})[:-keep]
+    for name in names:
+        if stem(name) in stale:
+            os.remove(os.path.join(out_dir, name))
@@ -0,0 +1,106 @@
+import random
+import asyncio
+from typing import Optional
+from image_generator import THEMES
+
+FAKE_REPLY = "fake llm reply"
+
+
+class FakeResponse:
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeModel:
+    def __init__(self, backend: "FakeGenAI", name: str):
+        self.backend = backend
+        self.model_name = name
+
+    async def generate_content_async(self, prompt: str, stream: bool = False):
+        if stream:
+            return await self.backend.stream(self.model_name, prompt)
+        return await self.backend.generate(self.model_name, prompt)
+
+
+class FakeStream:
+    def __init__(self, backend: "FakeGenAI", chunks: list[str], fail_at: Optional[int]):
+        self.backend = backend
+        self.chunks = chunks
+        self.fail_at = fail_at
+
+    async def __aiter__(self):
+        try:
+            for index, text in enumerate(self.chunks):
+                if index:
+                    await asyncio.sleep(self.backend.chunk_interval)
+                if index == self.fail_at:
+                    raise RuntimeError("stream reset by peer (fake)")
+                yield FakeResponse(text)
+        finally:
+            self.backend.in_flight -= 1
+
+
+class FakeGenAI:
+    """Stands in for the google.generativeai module, with configurable latency and failure rate."""
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.5, failure_rate: float = 0.0,
+                 chunk_interval: float = 0.15, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_interval = chunk_interval
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self.calls = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def configure(self, **kwargs) -> None:
+        pass
+
+    def GenerativeModel(self, name: str) -> FakeModel:
+        return FakeModel(self, name)
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "failures": self.failures, "max_in_flight": self.max_in_flight}
+
+    def reply_chunks(self) -> list[str]:
+        # Ends in a theme name so theme classification prompts get a usable answer too
+        words = f"{FAKE_REPLY} no cap this is lowkey the best take in the chat fr {self._random.choice(list(THEMES))}".split(" ")
+        return [" ".join(words[:3])] + [" " + " ".join(words[i:i + 3]) for i in range(3, len(words), 3)]
+
+    async def _first_chunk(self, model_name: str) -> None:
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        # Uniform in latency * (1 ± jitter)
+        await asyncio.sleep(max(0.0, self.latency * (1 + self.jitter * (2 * self._random.random() - 1))))
+
+    async def generate(self, model_name: str, prompt: str) -> FakeResponse:
+        # Takes as long as the whole stream would: time to the first chunk plus the rest
+        chunks = self.reply_chunks()
+        try:
+            await self._first_chunk(model_name)
+            if self._random.random() < self.failure_rate:
+                self.failures += 1
+                raise RuntimeError(f"503 {model_name} is overloaded (fake)")
+            await asyncio.sleep(self.chunk_interval * (len(chunks) - 1))
+        finally:
+            self.in_flight -= 1
+        return FakeResponse("".join(chunks))
+
+    async def stream(self, model_name: str, prompt: str) -> FakeStream:
+        # A failing stream breaks off at a random point, possibly before the first chunk
+        chunks = self.reply_chunks()
+        try:
+            await self._first_chunk(model_name)
+        except BaseException:
+            self.in_flight -= 1
+            raise
+        fail_at = None
+        if self._random.random() < self.failure_rate:
+            self.failures += 1
+            fail_at = self._random.randrange(len(chunks))
+        return FakeStream(self, chunks, fail_at)
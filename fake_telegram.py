@@ -0,0 +1,307 @@
+import json
+import time
+import asyncio
+import logging
+import argparse
+from io import BytesIO
+from collections import defaultdict, deque
+from typing import Optional
+from aiohttp import web, ClientSession
+
+logger = logging.getLogger(__name__)
+
+BOT_ID = 999000
+BOT_USERNAME = "fake_quote_bot"
+
+# Form fields PTB sends JSON-encoded; everything else (text, file ids, ...) arrives as a plain string
+JSON_FIELDS = {
+    "chat_id", "user_id", "message_id", "reply_to_message_id", "reply_parameters", "limit", "offset",
+    "timeout", "allowed_updates", "reply_markup", "max_connections", "drop_pending_updates",
+}
+
+
+def make_avatar_jpeg(size: int = 160) -> bytes:
+    from PIL import Image
+    output = BytesIO()
+    Image.linear_gradient("L").resize((size, size)).convert("RGB").save(output, format="JPEG")
+    return output.getvalue()
+
+
+class FakeTelegram:
+    """Just enough of the Bot API for the bot's handlers, for offline load tests."""
+
+    def __init__(self, token: str, latency: float = 0.0, upload_latency: float = 0.0):
+        self.token = token
+        self.latency = latency
+        self.upload_latency = upload_latency
+        self.webhook_url: Optional[str] = None
+        self.webhook_secret: Optional[str] = None
+        self.updates: asyncio.Queue = asyncio.Queue()
+        self.calls: dict[str, int] = defaultdict(int)
+        self.upload_bytes = 0
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._next_file_id = 1
+        self._waiters: dict[int, deque] = defaultdict(deque)
+        self._reply_waiters: dict[tuple[int, int], deque] = defaultdict(deque)
+        self._avatar = make_avatar_jpeg()
+
+    # -- updates ----------------------------------------------------------
+
+    def next_message_id(self) -> int:
+        self._next_message_id += 1
+        return self._next_message_id
+
+    def make_message(self, chat_id: int, user_id: int, text: str, first_name: str = "", reply_to: Optional[dict] = None) -> dict:
+        message = {
+            "message_id": self.next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private", "title": f"chat {chat_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": first_name or f"User{user_id}", "username": f"user{user_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        if reply_to:
+            message["reply_to_message"] = reply_to
+        return message
+
+    def make_update(self, message: dict) -> dict:
+        update = {"update_id": self._next_update_id, "message": message}
+        self._next_update_id += 1
+        return update
+
+    def make_callback_update(self, message: dict, user_id: int, data: str) -> dict:
+        query = {
+            "id": str(self._next_update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "chat_instance": str(message["chat"]["id"]),
+            "message": message,
+            "data": data,
+        }
+        update = {"update_id": self._next_update_id, "callback_query": query}
+        self._next_update_id += 1
+        return update
+
+    async def push_update(self, session: ClientSession, update: dict) -> None:
+        if self.webhook_url:
+            headers = {"X-Telegram-Bot-Api-Secret-Token": self.webhook_secret} if self.webhook_secret else {}
+            async with session.post(self.webhook_url, json=update, headers=headers) as resp:
+                if resp.status != 200:
+                    logger.error(f"Webhook rejected update {update['update_id']}: HTTP {resp.status}")
+        else:
+            await self.updates.put(update)
+
+    def expect_reply(self, chat_id: int) -> asyncio.Future:
+        # Resolved (FIFO per chat) by the next message the bot sends to this chat
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id].append(future)
+        return future
+
+    def expect_reply_to(self, chat_id: int, message_id: int, methods: Optional[tuple] = None) -> asyncio.Future:
+        # Resolved by the next message sent in reply to message_id (FIFO per message), optionally only by some methods
+        future = asyncio.get_running_loop().create_future()
+        self._reply_waiters[(chat_id, message_id)].append((future, methods))
+        return future
+
+    def _resolve(self, params: dict, method: str, message: Optional[dict] = None) -> None:
+        chat_id = params.get("chat_id")
+        reply_to = (params.get("reply_parameters") or {}).get("message_id") or params.get("reply_to_message_id")
+        reply_waiters = self._reply_waiters.get((chat_id, reply_to))
+        if reply_waiters:
+            for entry in list(reply_waiters):
+                future, methods = entry
+                if future.done():
+                    reply_waiters.remove(entry)
+                elif methods is None or method in methods:
+                    reply_waiters.remove(entry)
+                    future.set_result((method, time.perf_counter(), message))
+                    break
+            if not reply_waiters:
+                del self._reply_waiters[(chat_id, reply_to)]
+        waiters = self._waiters.get(chat_id)
+        while waiters:
+            future = waiters.popleft()
+            if not future.done():
+                future.set_result((method, time.perf_counter(), message))
+                return
+
+    # -- Bot API ----------------------------------------------------------
+
+    def _sent_message(self, params: dict, **extra) -> dict:
+        chat_id = params.get("chat_id", 0)
+        message = {
+            "message_id": self.next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Fake Quote Bot", "username": BOT_USERNAME},
+        }
+        message.update(extra)
+        return message
+
+    def _file_id(self) -> str:
+        self._next_file_id += 1
+        return f"fake-file-{self._next_file_id}"
+
+    async def _params(self, request: web.Request) -> dict:
+        params = {}
+        if request.content_type == "application/json":
+            return await request.json()
+        form = await request.post()
+        for key, value in form.items():
+            if isinstance(value, web.FileField):
+                data = value.file.read()
+                self.upload_bytes += len(data)
+                params[key] = data
+            elif key in JSON_FIELDS:
+                params[key] = json.loads(value)
+            else:
+                params[key] = value
+        return params
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        if request.match_info["token"] != self.token:
+            return web.json_response({"ok": False, "error_code": 401, "description": "Unauthorized"}, status=401)
+        method = request.match_info["method"]
+        params = await self._params(request)
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        handler = getattr(self, f"api_{method}", None)
+        if handler is None:
+            return web.json_response({"ok": False, "error_code": 404, "description": f"Not Found: method {method}"}, status=404)
+        try:
+            result = await handler(params)
+        except ValueError as e:
+            return web.json_response({"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}, status=400)
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        return web.Response(body=self._avatar, content_type="image/jpeg")
+
+    async def api_getMe(self, params):
+        return {"id": BOT_ID, "is_bot": True, "first_name": "Fake Quote Bot", "username": BOT_USERNAME,
+                "can_join_groups": True, "can_read_all_group_messages": True, "supports_inline_queries": False}
+
+    async def api_setWebhook(self, params):
+        self.webhook_url = params.get("url") or None
+        self.webhook_secret = params.get("secret_token") or None
+        return True
+
+    async def api_deleteWebhook(self, params):
+        self.webhook_url = None
+        return True
+
+    async def api_getUpdates(self, params):
+        timeout = params.get("timeout", 0) or 0
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout=max(timeout, 0.01)))
+        except asyncio.TimeoutError:
+            return []
+        while not self.updates.empty() and len(updates) < params.get("limit", 100):
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def api_sendChatAction(self, params):
+        return True
+
+    async def api_sendMessage(self, params):
+        message = self._sent_message(params, text=params.get("text", ""))
+        if params.get("reply_markup"):
+            message["reply_markup"] = params["reply_markup"]
+        self._resolve(params, "sendMessage", message)
+        return message
+
+    async def api_editMessageText(self, params):
+        message = self._sent_message(params, text=params.get("text", ""), edit_date=int(time.time()))
+        if params.get("message_id"):
+            message["message_id"] = params["message_id"]
+        if params.get("reply_markup"):
+            message["reply_markup"] = params["reply_markup"]
+        self._resolve(params, "editMessageText", message)
+        return message
+
+    async def api_answerCallbackQuery(self, params):
+        return True
+
+    async def api_sendPhoto(self, params):
+        photo = params.get("photo")
+        if isinstance(photo, str) and not photo.startswith("fake-file-"):
+            raise ValueError("wrong file identifier/HTTP URL specified")
+        if isinstance(photo, bytes) and self.upload_latency:
+            await asyncio.sleep(self.upload_latency)
+        file_id = photo if isinstance(photo, str) else self._file_id()
+        sizes = [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 400}]
+        self._resolve(params, "sendPhoto")
+        return self._sent_message(params, photo=sizes)
+
+    async def api_sendSticker(self, params):
+        sticker = params.get("sticker")
+        if isinstance(sticker, bytes) and self.upload_latency:
+            await asyncio.sleep(self.upload_latency)
+        file_id = sticker if isinstance(sticker, str) else self._file_id()
+        self._resolve(params, "sendSticker")
+        return self._sent_message(params, sticker={
+            "file_id": file_id, "file_unique_id": file_id, "width": 512, "height": 160,
+            "is_animated": False, "is_video": False, "type": "regular",
+        })
+
+    async def api_sendDocument(self, params):
+        document = params.get("document")
+        file_id = document if isinstance(document, str) else self._file_id()
+        self._resolve(params, "sendDocument")
+        return self._sent_message(params, document={"file_id": file_id, "file_unique_id": file_id})
+
+    async def api_getUserProfilePhotos(self, params):
+        # Even user ids have a profile photo, odd ones fall back to the letter avatar
+        if params.get("user_id", 0) % 2:
+            return {"total_count": 0, "photos": []}
+        user_id = params["user_id"]
+        sizes = [
+            {"file_id": f"avatar-{user_id}-{side}", "file_unique_id": f"avatar-{user_id}-{side}", "width": side, "height": side}
+            for side in (80, 160, 640)
+        ]
+        return {"total_count": 1, "photos": [sizes]}
+
+    async def api_getFile(self, params):
+        file_id = params.get("file_id", "")
+        return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self._avatar), "file_path": f"photos/{file_id}.jpg"}
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=20 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.handle_file)
+        return app
+
+
+async def start_fake_telegram(fake: FakeTelegram, host: str = "127.0.0.1", port: int = 8081) -> web.AppRunner:
+    runner = web.AppRunner(fake.build_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def _serve(args) -> None:
+    fake = FakeTelegram(args.token, latency=args.latency, upload_latency=args.upload_latency)
+    runner = await start_fake_telegram(fake, args.host, args.port)
+    print(f"Fake Bot API on http://{args.host}:{args.port} (set TELEGRAM_API_URL to this, BOT_TOKEN={args.token})")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a fake Telegram Bot API for offline testing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--token", default="123:fake")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every API call")
+    parser.add_argument("--upload-latency", type=float, default=0.0, help="extra seconds for photo/sticker uploads")
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,49 @@
+from io import BytesIO
+from PIL import Image
+
+STICKER_SIZE = 512
+
+# name -> (Pillow format, file extension)
+OUTPUT_FORMATS = {
+    "png": ("PNG", "png"),
+    "png_fast": ("PNG", "png"),
+    "png_palette": ("PNG", "png"),
+    "webp": ("WEBP", "webp"),
+    "webp_lossy": ("WEBP", "webp"),
+    "sticker": ("WEBP", "webp"),
+}
+
+DEFAULT_FORMAT = "png"
+
+
+def is_sticker(output_format: str) -> bool:
+    return output_format == "sticker"
+
+
+def file_extension(output_format: str) -> str:
+    return OUTPUT_FORMATS.get(output_format, OUTPUT_FORMATS[DEFAULT_FORMAT])[1]
+
+
+def fit_sticker(img: Image.Image) -> Image.Image:
+    # Telegram static stickers need one side at exactly 512px and the other at most 512px
+    scale = STICKER_SIZE / max(img.size)
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    return img.resize(size, Image.Resampling.LANCZOS)
+
+
+def encode_image(img: Image.Image, output_format: str = DEFAULT_FORMAT) -> bytes:
+    output = BytesIO()
+    if output_format == "png_fast":
+        img.save(output, format="PNG", compress_level=1)
+    elif output_format == "png_palette":
+        # Bubbles are a handful of flat colours plus anti-aliased text, so 256 colours is plenty
+        img.quantize(colors=256, method=Image.Quantize.FASTOCTREE).save(output, format="PNG", optimize=True)
+    elif output_format == "webp":
+        img.save(output, format="WEBP", lossless=True, quality=60, method=4)
+    elif output_format == "webp_lossy":
+        img.save(output, format="WEBP", quality=85, method=4)
+    elif output_format == "sticker":
+        fit_sticker(img).save(output, format="WEBP", quality=90, method=4)
+    else:
+        img.save(output, format="PNG")
+    return output.getvalue()
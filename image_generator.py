@@ -1,22 +1,119 @@
 import os
+import math
 import urllib.request
 from io import BytesIO
 from PIL import Image, ImageDraw, ImageFont
 from datetime import datetime
 import hashlib
+import logging
 import textwrap
+import threading
+from functools import lru_cache
 from typing import Optional
+from text_layout import wrap_text
+from image_encoder import encode_image, DEFAULT_FORMAT
+
+logger = logging.getLogger(__name__)
+
+FONT_SIZE_TEXT = 28
+FONT_SIZE_NAME = 28
+FONT_SIZE_TIME = 20
+FONT_SIZE_LETTER = 40
+AVATAR_SIZE = (80, 80)
+BUBBLE_PADDING_H = 24
+BUBBLE_PADDING_V = 16
+CIRCLE_SUPERSAMPLE = 4
+
+THEMES = {
+    "sigma": {"bg": "#0a0a0a", "bubble": "#222222", "text": "#ffffff", "time": "#888888", "avatar_bg": "#444444"},
+    "hacker": {"bg": "#000000", "bubble": "#002200", "text": "#00ff00", "time": "#008800", "avatar_bg": "#004400"},
+    "romantic": {"bg": "#ffe6ea", "bubble": "#ff88a7", "text": "#ffffff", "time": "#ffe6ea", "avatar_bg": "#ff3366"},
+    "hustle": {"bg": "#1a1600", "bubble": "#4d4000", "text": "#ffd700", "time": "#ccaa00", "avatar_bg": "#ffae00"},
+    "spooky": {"bg": "#0a0000", "bubble": "#330000", "text": "#ff8888", "time": "#cc0000", "avatar_bg": "#550000"},
+    "sad": {"bg": "#1c2841", "bubble": "#2d3e5e", "text": "#aabde6", "time": "#6a81b3", "avatar_bg": "#151e33"}
+}
+
+DEFAULT_THEME = {"bg": "#0e1621", "bubble": "#182533", "text": "#ffffff", "time": "#6e7f8d", "avatar_bg": None}
+
+# Looked up next to this file rather than in the working directory
+FONT_DIR = os.path.dirname(os.path.abspath(__file__))
+FONT_URLS = {
+    "Roboto-Regular.ttf": "https://github.com/googlefonts/roboto/raw/main/src/hinted/Roboto-Regular.ttf",
+    "Roboto-Bold.ttf": "https://github.com/googlefonts/roboto/raw/main/src/hinted/Roboto-Bold.ttf",
+}
+
+_font_paths: Optional[tuple[str, str]] = None
+_font_cache: dict[tuple[str, int], ImageFont.ImageFont] = {}
+_font_lock = threading.Lock()
 
 def download_font() -> tuple[str, str]:
-    font_reg = "Roboto-Regular.ttf"
-    font_bold = "Roboto-Bold.ttf"
-    
-    if not os.path.exists(font_reg):
-        urllib.request.urlretrieve("https://github.com/googlefonts/roboto/raw/main/src/hinted/Roboto-Regular.ttf", font_reg)
-    if not os.path.exists(font_bold):
-        urllib.request.urlretrieve("https://github.com/googlefonts/roboto/raw/main/src/hinted/Roboto-Bold.ttf", font_bold)
-        
-    return font_reg, font_bold
+    paths = []
+    for name, url in FONT_URLS.items():
+        path = os.path.join(FONT_DIR, name)
+        if not os.path.exists(path):
+            # The fonts ship next to this file; reaching the network here means the build lost them
+            logger.warning(f"{path} is missing, downloading it at runtime")
+            urllib.request.urlretrieve(url, path)
+        paths.append(path)
+    return paths[0], paths[1]
+
+def validate_fonts() -> list[str]:
+    problems = []
+    for name in FONT_URLS:
+        path = os.path.join(FONT_DIR, name)
+        if not os.path.exists(path):
+            problems.append(f"{path} is missing")
+            continue
+        try:
+            font = ImageFont.truetype(path, FONT_SIZE_TEXT)
+        except OSError as e:
+            problems.append(f"{path} is not a usable font: {e}")
+            continue
+        if font.getlength("Aa") <= 0:
+            problems.append(f"{path} has no glyphs for basic Latin text")
+    return problems
+
+def get_font_paths() -> tuple[str, str]:
+    # download_font() hits the filesystem (and maybe the network), so resolve it once per process
+    global _font_paths
+    if _font_paths is None:
+        with _font_lock:
+            if _font_paths is None:
+                _font_paths = download_font()
+    return _font_paths
+
+def get_font(path: str, size: int) -> ImageFont.ImageFont:
+    key = (path, size)
+    font = _font_cache.get(key)
+    if font is not None:
+        return font
+    with _font_lock:
+        font = _font_cache.get(key)
+        if font is None:
+            try:
+                font = ImageFont.truetype(path, size)
+            except IOError:
+                font = ImageFont.load_default()
+            _font_cache[key] = font
+    return font
+
+def get_fonts() -> tuple[ImageFont.ImageFont, ImageFont.ImageFont, ImageFont.ImageFont, ImageFont.ImageFont]:
+    reg_font_path, bold_font_path = get_font_paths()
+    return (
+        get_font(reg_font_path, FONT_SIZE_TEXT),
+        get_font(bold_font_path, FONT_SIZE_NAME),
+        get_font(reg_font_path, FONT_SIZE_TIME),
+        get_font(bold_font_path, FONT_SIZE_LETTER),
+    )
+
+def warm_fonts() -> None:
+    get_fonts()
+
+def get_theme(theme: str, name: str) -> dict:
+    colors = THEMES.get(theme)
+    if colors is None:
+        colors = dict(DEFAULT_THEME, avatar_bg=get_name_color(name))
+    return colors
 
 def get_name_color(name: str) -> str:
     colors = [
@@ -26,129 +123,93 @@ def get_name_color(name: str) -> str:
     hash_val = int(hashlib.md5(name.encode('utf-8')).hexdigest(), 16)
     return colors[hash_val % len(colors)]
 
-def make_circle(image: Image.Image, size: tuple[int, int]) -> Image.Image:
-    image = image.resize(size, Image.Resampling.LANCZOS).convert("RGBA")
-    mask = Image.new('L', size, 0)
+@lru_cache(maxsize=16)
+def circle_mask(size: tuple[int, int]) -> Image.Image:
+    # Drawn at 4x and downsampled so the edge gets anti-aliased alpha instead of a hard stair-step
+    big = (size[0] * CIRCLE_SUPERSAMPLE, size[1] * CIRCLE_SUPERSAMPLE)
+    mask = Image.new('L', big, 0)
     draw = ImageDraw.Draw(mask)
-    draw.ellipse((0, 0, size[0], size[1]), fill=255)
-    
-    result = Image.new('RGBA', size, (0, 0, 0, 0))
-    result.paste(image, (0, 0), mask=mask)
+    draw.ellipse((0, 0, big[0] - 1, big[1] - 1), fill=255)
+    return mask.resize(size, Image.Resampling.BOX)
+
+def make_circle(image: Image.Image, size: tuple[int, int]) -> Image.Image:
+    if image.size != size:
+        image = image.resize(size, Image.Resampling.LANCZOS)
+    # convert() always returns a new image, so the cached mask can be written into it directly
+    result = image.convert("RGBA")
+    result.putalpha(circle_mask(size))
     return result
 
-def get_wrapped_lines(text: str, font: ImageFont.FreeTypeFont, max_width: int) -> list[str]:
-    lines = []
-    paragraphs = text.split('\n')
-    for p in paragraphs:
-        if not p.strip():
-            lines.append("")
-            continue
-        words = p.split(' ')
-        current_line = words[0]
-        for word in words[1:]:
-            bbox = font.getbbox(current_line + " " + word)
-            w = bbox[2] - bbox[0]
-            if w <= max_width:
-                current_line += " " + word
-            else:
-                lines.append(current_line)
-                current_line = word
-        lines.append(current_line)
-    return lines
-
-def create_quote_image(avatar_bytes: Optional[bytes], name: str, text: str, theme: str = "default") -> BytesIO:
-    reg_font_path, bold_font_path = download_font()
-    
-    font_size_text = 28
-    font_size_name = 28
-    font_size_time = 20
-    
+@lru_cache(maxsize=256)
+def letter_avatar(letter: str, color: str) -> Image.Image:
+    # Shared between renders; callers only ever paste from it
+    font_letter = get_fonts()[3]
+    avatar_size = AVATAR_SIZE
+    avatar = Image.new("RGB", avatar_size, color)
+    draw_temp = ImageDraw.Draw(avatar)
+    bbox = draw_temp.textbbox((0, 0), letter, font=font_letter)
+    w = bbox[2] - bbox[0]
+    h = bbox[3] - bbox[1]
+    draw_temp.text(((avatar_size[0] - w) / 2, (avatar_size[1] - h) / 2 - 8), letter, font=font_letter, fill="white")
+    return make_circle(avatar, avatar_size)
+
+def open_avatar(avatar_bytes: bytes) -> Image.Image:
+    avatar = Image.open(BytesIO(avatar_bytes))
+    # Let the JPEG decoder downscale by a power of two while decoding; we only need 80px
+    avatar.draft("RGB", (AVATAR_SIZE[0] * 2, AVATAR_SIZE[1] * 2))
+    return avatar
+
+def prepare_avatar(avatar_bytes: bytes) -> Optional[bytes]:
+    # Downscale + circle-mask once so cached avatars can be dropped straight into the canvas
     try:
-        font_text = ImageFont.truetype(reg_font_path, font_size_text)
-        font_name = ImageFont.truetype(bold_font_path, font_size_name)
-        font_time = ImageFont.truetype(reg_font_path, font_size_time)
-    except IOError:
-        font_text = ImageFont.load_default()
-        font_name = ImageFont.load_default()
-        font_time = ImageFont.load_default()
-
-    avatar_size = (80, 80)
-    
-    themes_dict = {
-        "sigma": {"bg": "#0a0a0a", "bubble": "#222222", "text": "#ffffff", "time": "#888888", "avatar_bg": "#444444"},
-        "hacker": {"bg": "#000000", "bubble": "#002200", "text": "#00ff00", "time": "#008800", "avatar_bg": "#004400"},
-        "romantic": {"bg": "#ffe6ea", "bubble": "#ff88a7", "text": "#ffffff", "time": "#ffe6ea", "avatar_bg": "#ff3366"},
-        "hustle": {"bg": "#1a1600", "bubble": "#4d4000", "text": "#ffd700", "time": "#ccaa00", "avatar_bg": "#ffae00"},
-        "spooky": {"bg": "#0a0000", "bubble": "#330000", "text": "#ff8888", "time": "#cc0000", "avatar_bg": "#550000"},
-        "sad": {"bg": "#1c2841", "bubble": "#2d3e5e", "text": "#aabde6", "time": "#6a81b3", "avatar_bg": "#151e33"}
-    }
-    
-    if theme in themes_dict:
-        bg_color = themes_dict[theme]["bg"]
-        bubble_color = themes_dict[theme]["bubble"]
-        text_color = themes_dict[theme]["text"]
-        time_color = themes_dict[theme]["time"]
-        avatar_bg_color = themes_dict[theme]["avatar_bg"]
-    else:
-        bg_color = "#0e1621"
-        bubble_color = "#182533"
-        text_color = "#ffffff"
-        time_color = "#6e7f8d"
-        avatar_bg_color = get_name_color(name)
-        
-    avatar = None
-    
-    if avatar_bytes:
-        try:
-            avatar = Image.open(BytesIO(avatar_bytes)).convert("RGB")
-        except Exception:
-            avatar = None
-            
-    if not avatar_bytes or avatar is None:
-        avatar = Image.new("RGB", avatar_size, avatar_bg_color)
-        draw_temp = ImageDraw.Draw(avatar)
-        try:
-            temp_font = ImageFont.truetype(bold_font_path, 40)
-        except Exception:
-            temp_font = font_name
-            
-        letter = name[0].upper() if name else "?"
-        bbox = draw_temp.textbbox((0, 0), letter, font=temp_font)
-        w = bbox[2] - bbox[0]
-        h = bbox[3] - bbox[1]
-        draw_temp.text(((avatar_size[0] - w) / 2, (avatar_size[1] - h) / 2 - 8), letter, font=temp_font, fill="white")
-        
-    avatar = make_circle(avatar, avatar_size)
+        avatar = open_avatar(avatar_bytes).convert("RGB")
+    except Exception:
+        return None
+    output = BytesIO()
+    make_circle(avatar, AVATAR_SIZE).save(output, format="PNG")
+    return output.getvalue()
+
+def get_wrapped_lines(text: str, font: Optional[ImageFont.FreeTypeFont], max_width: int) -> list[str]:
+    if font is None:
+        font = get_fonts()[0]
+    return [line for line, _ in wrap_text(text, font, max_width)]
+
+def compute_layout(name: str, text: str, time_text: Optional[str] = None, show_name: bool = True) -> dict:
+    # Everything here depends only on name/text/time, so it can run before the avatar and theme are known
+    font_text, font_name, font_time, _ = get_fonts()
+    font_size_text = FONT_SIZE_TEXT
+    font_size_time = FONT_SIZE_TIME
     
     max_text_width = 800
-    lines = get_wrapped_lines(text, font_text, max_text_width)
+    wrapped = wrap_text(text, font_text, max_text_width)
+    lines = [line for line, _ in wrapped]
     
-    temp_img = Image.new("RGB", (1, 1))
-    temp_draw = ImageDraw.Draw(temp_img)
-    name_bbox = temp_draw.textbbox((0, 0), name, font=font_name)
-    name_width = name_bbox[2] - name_bbox[0]
-    name_height = name_bbox[3] - name_bbox[1]
+    if show_name:
+        name_bbox = font_name.getbbox(name)
+        name_width = name_bbox[2] - name_bbox[0]
+        name_height = name_bbox[3] - name_bbox[1]
+        name_gap = 10
+    else:
+        name_width = name_height = name_gap = 0
     
-    line_bboxes = [temp_draw.textbbox((0, 0), line if line else "A", font=font_text) for line in lines]
-    text_width = max([bbox[2] - bbox[0] for bbox in line_bboxes] + [0])
+    text_width = math.ceil(max([width for _, width in wrapped] + [0]))
     
     avg_line_height = font_size_text + 6
     total_text_height = sum([avg_line_height if line else avg_line_height // 2 for line in lines])
     
-    time_text = datetime.now().strftime("%H:%M")
-    time_bbox = temp_draw.textbbox((0, 0), time_text, font=font_time)
+    if time_text is None:
+        time_text = datetime.now().strftime("%H:%M")
+    time_bbox = font_time.getbbox(time_text)
     time_width = time_bbox[2] - time_bbox[0]
     time_height = time_bbox[3] - time_bbox[1]
     
-    bubble_padding_h = 24
-    bubble_padding_v = 16
+    bubble_padding_h = BUBBLE_PADDING_H
+    bubble_padding_v = BUBBLE_PADDING_V
     
     bubble_content_width = max(name_width, text_width)
     bubble_width = bubble_content_width + bubble_padding_h * 2
     
-    last_line = lines[-1] if lines else ""
-    last_line_bbox = temp_draw.textbbox((0, 0), last_line, font=font_text)
-    last_line_width = last_line_bbox[2] - last_line_bbox[0]
+    last_line_width = math.ceil(wrapped[-1][1]) if wrapped else 0
     
     if bubble_content_width - last_line_width > time_width + 16:
         pass
@@ -157,51 +218,146 @@ def create_quote_image(avatar_bytes: Optional[bytes], name: str, text: str, them
         bubble_width = max(bubble_width, last_line_width + time_width + bubble_padding_h * 2 + 16)
         
     bubble_width = max(bubble_width, name_width + bubble_padding_h * 2)
-    bubble_height = bubble_padding_v + name_height + 10 + total_text_height + bubble_padding_v
-    
-    padding_bg_h = 40
-    padding_bg_v = 40
-    img_width = padding_bg_h + avatar_size[0] + 16 + bubble_width + padding_bg_h + 80
-    img_height = padding_bg_v + max(avatar_size[1], bubble_height) + padding_bg_v
+    bubble_height = bubble_padding_v + name_height + name_gap + total_text_height + bubble_padding_v
     
-    img = Image.new("RGBA", (int(img_width), int(img_height)), bg_color)
-    draw = ImageDraw.Draw(img)
-    
-    avatar_x = padding_bg_h
-    avatar_y = img_height - padding_bg_v - avatar_size[1]
-    img.paste(avatar, (avatar_x, int(avatar_y)), avatar)
+    return {
+        "lines": lines,
+        "show_name": show_name,
+        "name_height": name_height,
+        "time_text": time_text,
+        "time_width": time_width,
+        "time_height": time_height,
+        "bubble_width": bubble_width,
+        "bubble_height": bubble_height,
+    }
+
+def load_avatar(avatar_bytes: Optional[bytes], name: str, avatar_bg_color: str) -> Image.Image:
+    avatar_size = AVATAR_SIZE
+    if avatar_bytes:
+        try:
+            avatar = open_avatar(avatar_bytes)
+            # Output of prepare_avatar() is already a masked RGBA circle at the right size
+            if avatar.mode == "RGBA" and avatar.size == avatar_size:
+                return avatar
+            return make_circle(avatar.convert("RGB"), avatar_size)
+        except Exception:
+            pass
+    letter = name[0].upper() if name else "?"
+    return letter_avatar(letter, avatar_bg_color)
+
+def draw_bubble(draw: ImageDraw.ImageDraw, bubble_x: int, bubble_bottom: int, layout: dict, name: str, colors: dict, tail: bool = True) -> None:
+    font_text, font_name, font_time, _ = get_fonts()
+    bubble_width = layout["bubble_width"]
+    bubble_height = layout["bubble_height"]
+    avg_line_height = FONT_SIZE_TEXT + 6
+    bubble_padding_h = BUBBLE_PADDING_H
+    bubble_padding_v = BUBBLE_PADDING_V
     
-    bubble_x = avatar_x + avatar_size[0] + 16
-    bubble_y = img_height - padding_bg_v - bubble_height
+    bubble_y = bubble_bottom - bubble_height
     
     bubble_radius = 24
-    draw.rounded_rectangle([bubble_x, bubble_y, bubble_x + bubble_width, bubble_y + bubble_height], radius=bubble_radius, fill=bubble_color)
+    draw.rounded_rectangle([bubble_x, bubble_y, bubble_x + bubble_width, bubble_y + bubble_height], radius=bubble_radius, fill=colors["bubble"])
     
-    tail_polygon = [
-        (bubble_x, img_height - padding_bg_v - 20),
-        (bubble_x - 12, img_height - padding_bg_v),
-        (bubble_x + 24, img_height - padding_bg_v)
-    ]
-    draw.polygon(tail_polygon, fill=bubble_color)
+    if tail:
+        tail_polygon = [
+            (bubble_x, bubble_bottom - 20),
+            (bubble_x - 12, bubble_bottom),
+            (bubble_x + 24, bubble_bottom)
+        ]
+        draw.polygon(tail_polygon, fill=colors["bubble"])
     
     text_x = bubble_x + bubble_padding_h
     current_y = bubble_y + bubble_padding_v - 4
     
-    draw.text((text_x, current_y), name, font=font_name, fill=avatar_bg_color)
-    current_y += name_height + 14
+    if layout.get("show_name", True):
+        draw.text((text_x, current_y), name, font=font_name, fill=colors["avatar_bg"])
+        current_y += layout["name_height"] + 14
+    else:
+        current_y += 4
     
-    for line in lines:
+    for line in layout["lines"]:
         if line:
-            draw.text((text_x, current_y), line, font=font_text, fill=text_color)
+            draw.text((text_x, current_y), line, font=font_text, fill=colors["text"])
             current_y += avg_line_height
         else:
             current_y += avg_line_height // 2
             
-    time_x = bubble_x + bubble_width - bubble_padding_h - time_width
-    time_y = bubble_y + bubble_height - bubble_padding_v - time_height + 6
-    draw.text((time_x, time_y), time_text, font=font_time, fill=time_color)
+    time_x = bubble_x + bubble_width - bubble_padding_h - layout["time_width"]
+    time_y = bubble_y + bubble_height - bubble_padding_v - layout["time_height"] + 6
+    draw.text((time_x, time_y), layout["time_text"], font=font_time, fill=colors["time"])
+
+def group_messages(messages: list[dict]) -> list[list[dict]]:
+    # Consecutive messages from the same sender share one avatar and one name label, like Telegram
+    groups = []
+    for msg in messages:
+        sender = msg.get("sender", msg["name"])
+        if groups and groups[-1][0].get("sender", groups[-1][0]["name"]) == sender:
+            groups[-1].append(msg)
+        else:
+            groups.append([msg])
+    return groups
+
+def layout_messages(messages: list[dict]) -> list[list[tuple[dict, dict]]]:
+    # One measuring pass over every message before anything is drawn
+    return [
+        [(msg, compute_layout(msg["name"], msg["text"], msg.get("time_text"), show_name=(i == 0)))
+         for i, msg in enumerate(group)]
+        for group in group_messages(messages)
+    ]
+
+def render_multi_quote(messages: list[dict], theme: str = "default") -> Image.Image:
+    """Render messages (dicts with name, text and optional avatar, time_text, sender) as stacked bubbles."""
+    avatar_size = AVATAR_SIZE
+    groups = layout_messages(messages)
     
-    output = BytesIO()
-    img.save(output, format="PNG")
-    output.seek(0)
-    return output
+    bubble_gap = 6
+    group_gap = 16
+    group_heights = []
+    for group in groups:
+        bubbles_height = sum(layout["bubble_height"] for _, layout in group) + bubble_gap * (len(group) - 1)
+        group_heights.append(max(avatar_size[1], bubbles_height))
+    max_bubble_width = max(layout["bubble_width"] for group in groups for _, layout in group)
+    
+    padding_bg_h = 40
+    padding_bg_v = 40
+    img_width = padding_bg_h + avatar_size[0] + 16 + max_bubble_width + padding_bg_h + 80
+    img_height = padding_bg_v + sum(group_heights) + group_gap * (len(groups) - 1) + padding_bg_v
+    
+    bg_color = get_theme(theme, "")["bg"]
+    img = Image.new("RGBA", (int(img_width), int(img_height)), bg_color)
+    draw = ImageDraw.Draw(img)
+    
+    avatar_x = padding_bg_h
+    bubble_x = avatar_x + avatar_size[0] + 16
+    group_top = padding_bg_v
+    for group, group_height in zip(groups, group_heights):
+        first = group[0][0]
+        colors = get_theme(theme, first["name"])
+        group_bottom = group_top + group_height
+        
+        avatar = load_avatar(first.get("avatar"), first["name"], colors["avatar_bg"])
+        img.paste(avatar, (avatar_x, int(group_bottom - avatar_size[1])), avatar)
+        
+        bubble_bottom = group_bottom
+        for i in range(len(group) - 1, -1, -1):
+            msg, layout = group[i]
+            draw_bubble(draw, bubble_x, bubble_bottom, layout, first["name"], colors, tail=(i == len(group) - 1))
+            bubble_bottom -= layout["bubble_height"] + bubble_gap
+        group_top = group_bottom + group_gap
+    return img
+
+def create_multi_quote_image(messages: list[dict], theme: str = "default", output_format: str = DEFAULT_FORMAT) -> BytesIO:
+    return BytesIO(encode_image(render_multi_quote(messages, theme), output_format))
+
+def create_quote_image(avatar_bytes: Optional[bytes], name: str, text: str, theme: str = "default", time_text: Optional[str] = None, output_format: str = DEFAULT_FORMAT) -> BytesIO:
+    message = {"avatar": avatar_bytes, "name": name, "text": text, "time_text": time_text}
+    return create_multi_quote_image([message], theme, output_format)
+
+if __name__ == "__main__":
+    # Build-time step: fetch any missing fonts and fail the build if they can't be used
+    import sys
+    download_font()
+    problems = validate_fonts()
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    sys.exit(1 if problems else 0)
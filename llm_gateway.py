@@ -0,0 +1,393 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Optional
+from metrics import counter, histogram
+
+logger = logging.getLogger(__name__)
+
+LLM_CALLS = counter("bot_llm_calls_total", "Gemini calls, by model", ("model",))
+LLM_ERRORS = counter("bot_llm_errors_total", "Failed Gemini calls (timeouts included), by model", ("model",))
+LLM_TIMEOUTS = counter("bot_llm_timeouts_total", "Gemini calls that timed out or stalled, by model", ("model",))
+LLM_SECONDS = histogram(
+    "bot_llm_seconds", "Gemini call latency by model; streams count until the last chunk", ("model",),
+    buckets=(0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 20.0, 30.0, 60.0),
+)
+
+PRIMARY_MODEL = "gemini-3-flash-preview"
+FALLBACK_MODEL = "gemini-2.5-flash"
+
+
+class LLMError(Exception):
+    pass
+
+
+class LLMBusyError(LLMError):
+    pass
+
+
+class CircuitBreaker:
+    # closed -> open after `failure_threshold` consecutive failures; after `cooldown` one trial call is let through
+    def __init__(self, failure_threshold: int = 3, cooldown: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._trial_running:
+            self._trial_running = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self._trial_running or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning(f"Circuit opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+        self._trial_running = False
+
+    def abandon(self) -> None:
+        self._trial_running = False
+
+
+class ModelStats:
+    # Per-model totals for /stats-style reports; every update also goes to the labeled Prometheus series
+    __slots__ = ("model", "calls", "errors", "timeouts", "total_latency", "max_latency")
+
+    def __init__(self, model: str):
+        self.model = model
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record_call(self) -> None:
+        self.calls += 1
+        LLM_CALLS.inc(self.model)
+
+    def record_error(self, timeout: bool = False) -> None:
+        self.errors += 1
+        LLM_ERRORS.inc(self.model)
+        if timeout:
+            self.timeouts += 1
+            LLM_TIMEOUTS.inc(self.model)
+
+    def record_latency(self, latency: float) -> None:
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        LLM_SECONDS.observe(latency, self.model)
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "avg_latency": self.total_latency / self.calls if self.calls else 0.0,
+            "max_latency": self.max_latency,
+        }
+
+
+class FairScheduler:
+    """Hands out LLM slots round-robin across chats, so one busy chat queues behind itself, not in front of everyone.
+
+    Calls without a chat (theme lookups) share one lane in the rotation and skip the per-chat cap.
+    Once `max_pending` calls are waiting, or a call has waited `timeout` seconds, LLMBusyError is raised.
+    Background calls (chat summaries) never queue: they only take a slot while nobody is waiting and at least
+    half the slots are free, and get LLMBusyError straight away otherwise.
+    """
+
+    def __init__(self, max_concurrency: int, per_chat: int, max_pending: int, timeout: float):
+        self.max_concurrency = max_concurrency
+        self.per_chat = per_chat
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.running = 0
+        self.pending = 0
+        self.rejected = 0
+        self.rejected_background = 0
+        self._running_by_chat: dict = {}
+        # chat -> waiters in arrival order; dict order is the rotation
+        self._waiting: OrderedDict[object, deque] = OrderedDict()
+
+    def _can_run(self, chat_id) -> bool:
+        return self.running < self.max_concurrency and (chat_id is None or self._running_by_chat.get(chat_id, 0) < self.per_chat)
+
+    def _start(self, chat_id) -> None:
+        self.running += 1
+        if chat_id is not None:
+            self._running_by_chat[chat_id] = self._running_by_chat.get(chat_id, 0) + 1
+
+    async def acquire(self, chat_id, background: bool = False) -> None:
+        if background:
+            if self._waiting or self.running >= max(1, self.max_concurrency // 2) or not self._can_run(chat_id):
+                self.rejected_background += 1
+                raise LLMBusyError("no spare LLM capacity for background work")
+            self._start(chat_id)
+            return
+        if chat_id not in self._waiting and self._can_run(chat_id):
+            self._start(chat_id)
+            return
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise LLMBusyError(f"LLM queue full ({self.pending} waiting)")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(chat_id, deque()).append(future)
+        self.pending += 1
+        try:
+            await asyncio.wait_for(future, timeout=self.timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we gave up on it
+                self.release(chat_id)
+            else:
+                # release() may already have dropped it from the queue
+                queue = self._waiting.get(chat_id)
+                if queue is not None and future in queue:
+                    queue.remove(future)
+                    self.pending -= 1
+                    if not queue:
+                        del self._waiting[chat_id]
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise LLMBusyError(f"no LLM slot within {self.timeout}s")
+            raise
+
+    def release(self, chat_id) -> None:
+        self.running -= 1
+        if chat_id is not None:
+            left = self._running_by_chat[chat_id] - 1
+            if left:
+                self._running_by_chat[chat_id] = left
+            else:
+                del self._running_by_chat[chat_id]
+        # One grant per chat per pass; a chat that got a slot goes to the back of the rotation
+        for waiting_chat in list(self._waiting):
+            if self.running >= self.max_concurrency:
+                break
+            if not self._can_run(waiting_chat):
+                continue
+            queue = self._waiting.pop(waiting_chat)
+            # A waiter that just timed out or was cancelled leaves its future here until its cleanup runs
+            while queue and queue[0].done():
+                queue.popleft()
+                self.pending -= 1
+            if not queue:
+                continue
+            future = queue.popleft()
+            self.pending -= 1
+            if queue:
+                self._waiting[waiting_chat] = queue
+            self._start(waiting_chat)
+            future.set_result(None)
+
+
+class LLMGateway:
+    def __init__(self, primary: str = PRIMARY_MODEL, fallback: str = FALLBACK_MODEL, max_concurrency: int = 16,
+                 per_chat_concurrency: int = 2, timeout: float = 30.0, failure_threshold: int = 3, cooldown: float = 60.0,
+                 api_key: Optional[str] = None, max_pending: int = 64, queue_timeout: float = 10.0):
+        self.primary = primary
+        self.fallback = fallback
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+        self.scheduler = FairScheduler(max_concurrency, per_chat_concurrency, max_pending, queue_timeout)
+        # (chat_id, prompt) -> the generation every identical request currently waits on
+        self._inflight: dict[tuple, asyncio.Task] = {}
+        self.coalesced = 0
+        self.api_key = api_key
+        self._genai = None
+        self._models: dict = {}
+        self.stats: dict[str, ModelStats] = {}
+
+    def load_sdk(self):
+        # google.generativeai takes over a second to import, so it stays off the startup path
+        if self._genai is None:
+            import google.generativeai as genai
+            if self.api_key:
+                genai.configure(api_key=self.api_key)
+            self._genai = genai
+        return self._genai
+
+    def set_sdk(self, sdk) -> None:
+        # Swaps in a stand-in for google.generativeai (see fake_genai.py)
+        self._genai = sdk
+        self._models.clear()
+
+    def get_model(self, name: str):
+        model = self._models.get(name)
+        if model is None:
+            model = self._models[name] = self.load_sdk().GenerativeModel(name)
+        return model
+
+    def _model_stats(self, model_name: str) -> ModelStats:
+        stats = self.stats.get(model_name)
+        if stats is None:
+            stats = self.stats[model_name] = ModelStats(model_name)
+        return stats
+
+    def metrics(self) -> dict:
+        return {
+            "breaker": self.breaker.state,
+            "running": self.scheduler.running,
+            "queued": self.scheduler.pending,
+            "rejected": self.scheduler.rejected,
+            "rejected_background": self.scheduler.rejected_background,
+            "coalesced": self.coalesced,
+            "models": {name: s.as_dict() for name, s in self.stats.items()},
+        }
+
+    async def _call(self, model_name: str, prompt: str) -> str:
+        stats = self._model_stats(model_name)
+        stats.record_call()
+        start = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(self.get_model(model_name).generate_content_async(prompt), timeout=self.timeout)
+            return response.text
+        except asyncio.TimeoutError:
+            stats.record_error(timeout=True)
+            raise LLMError(f"{model_name} timed out after {self.timeout}s")
+        except Exception:
+            stats.record_error()
+            raise
+        finally:
+            stats.record_latency(time.perf_counter() - start)
+
+    async def generate(self, prompt: str, chat_id=None, background: bool = False) -> str:
+        # Identical requests from the same chat (five people spamming /rizz on one message) share one generation
+        key = (chat_id, prompt)
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = self._inflight[key] = asyncio.ensure_future(self._generate(prompt, chat_id, background))
+            task.add_done_callback(lambda t: self._finished(key, t))
+        # Shielded so one impatient caller doesn't cancel the generation for the others
+        return await asyncio.shield(task)
+
+    def _finished(self, key: tuple, future: asyncio.Future) -> None:
+        del self._inflight[key]
+        if not future.cancelled():
+            # Mark retrieved so a failure nobody is left waiting on doesn't log "exception never retrieved"
+            future.exception()
+
+    async def stream(self, prompt: str, chat_id=None):
+        """Yields the reply in chunks as the model produces them.
+
+        Falls back to the other model only if the primary fails before its first chunk; a stream that breaks
+        off later raises LLMError after the chunks already yielded. A duplicate of a prompt that is already
+        being generated gets the finished text as a single chunk.
+        """
+        key = (chat_id, prompt)
+        shared = self._inflight.get(key)
+        if shared is not None:
+            self.coalesced += 1
+            yield await asyncio.shield(shared)
+            return
+        done = self._inflight[key] = asyncio.get_running_loop().create_future()
+        done.add_done_callback(lambda f: self._finished(key, f))
+        parts = []
+        try:
+            async for chunk in self._stream(prompt, chat_id):
+                parts.append(chunk)
+                yield chunk
+        except BaseException as e:
+            done.set_exception(e if isinstance(e, Exception) else LLMError("stream abandoned"))
+            raise
+        done.set_result("".join(parts))
+
+    async def _stream(self, prompt: str, chat_id):
+        if self._genai is None:
+            await asyncio.to_thread(self.load_sdk)
+        await self.scheduler.acquire(chat_id)
+        try:
+            if self.breaker.allow():
+                started = False
+                try:
+                    async for chunk in self._call_stream(self.primary, prompt):
+                        started = True
+                        yield chunk
+                    self.breaker.record_success()
+                    return
+                except (asyncio.CancelledError, GeneratorExit):
+                    self.breaker.abandon()
+                    raise
+                except Exception as e:
+                    self.breaker.record_failure()
+                    logger.error(f"GenAI error on {self.primary}: {e}")
+                    if started:
+                        raise LLMError(f"{self.primary} stream broke off: {e}") from e
+            try:
+                async for chunk in self._call_stream(self.fallback, prompt):
+                    yield chunk
+            except Exception as e:
+                raise LLMError(f"{self.fallback} failed: {e}") from e
+        finally:
+            self.scheduler.release(chat_id)
+
+    async def _call_stream(self, model_name: str, prompt: str):
+        # Same bookkeeping as _call; the timeout applies to the first chunk and to each gap between chunks
+        stats = self._model_stats(model_name)
+        stats.record_call()
+        start = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(self.get_model(model_name).generate_content_async(prompt, stream=True), timeout=self.timeout)
+            chunks = response.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout=self.timeout)
+                except StopAsyncIteration:
+                    break
+                if chunk.text:
+                    yield chunk.text
+        except asyncio.TimeoutError:
+            stats.record_error(timeout=True)
+            raise LLMError(f"{model_name} stalled for {self.timeout}s")
+        except Exception:
+            stats.record_error()
+            raise
+        finally:
+            stats.record_latency(time.perf_counter() - start)
+
+    async def _generate(self, prompt: str, chat_id, background: bool = False) -> str:
+        if self._genai is None:
+            await asyncio.to_thread(self.load_sdk)
+        await self.scheduler.acquire(chat_id, background)
+        try:
+            if self.breaker.allow():
+                try:
+                    text = await self._call(self.primary, prompt)
+                    self.breaker.record_success()
+                    return text
+                except asyncio.CancelledError:
+                    self.breaker.abandon()
+                    raise
+                except Exception as e:
+                    self.breaker.record_failure()
+                    logger.error(f"GenAI error on {self.primary}: {e}")
+            try:
+                return await self._call(self.fallback, prompt)
+            except Exception as e:
+                raise LLMError(f"{self.fallback} failed: {e}") from e
+        finally:
+            self.scheduler.release(chat_id)
@@ -0,0 +1,334 @@
+"""Drives the real bot Application with synthetic traffic against local stand-ins for Telegram and Gemini.
+
+    python loadtest.py --chats 50 --commands 2000 --rate 100 --llm-latency 0.8 --llm-failure-rate 0.05
+
+Everything runs in this process and on one event loop: the fake Bot API, the traffic driver and the bot
+itself (renders still go to the render pool). Loop lag therefore includes the harness's own work, which
+is small next to the bot's.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import shutil
+from collections import defaultdict
+from aiohttp import ClientSession
+from fake_telegram import FakeTelegram, start_fake_telegram, BOT_USERNAME
+from fake_genai import FakeGenAI, FAKE_REPLY
+
+TOKEN = "123:loadtest"
+COMMANDS = ("quote", "quote_funny", "roast", "mention")
+QUOTE_COMMANDS = {"quote", "quote_funny"}
+SAMPLE_TEXTS = [
+    "bro really said he'd be on time and showed up two hours late",
+    "I'm not saying I'm a genius but I did fix the server with sudo",
+    "grind now, cry later, get rich eventually 💰",
+    "that ghost story last night was actually haunted fr 👻",
+    "miss you already, come back 😢",
+    "alpha mindset, lone wolf energy, sigma grindset",
+    "who ate my fries",
+    "love you babe ❤️ see you on our date",
+]
+
+
+def parse_mix(text: str) -> dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in COMMANDS:
+            raise argparse.ArgumentTypeError(f"unknown command {name!r}, expected one of {', '.join(COMMANDS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def summarize(values: list[float]) -> dict:
+    return {
+        "p50_ms": round(percentile(values, 50) * 1000, 1),
+        "p90_ms": round(percentile(values, 90) * 1000, 1),
+        "p99_ms": round(percentile(values, 99) * 1000, 1),
+        "max_ms": round(max(values, default=0.0) * 1000, 1),
+    }
+
+
+class LoopLagMonitor:
+    # How late a short sleep wakes up is how long something else held the loop
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: list[float] = []
+
+    async def run(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self.interval))
+
+
+class LoadDriver:
+    def __init__(self, fake, session: ClientSession, args):
+        self.fake = fake
+        self.session = session
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.chats = [-(1000000 + i) for i in range(args.chats)]
+        self.names = list(args.mix)
+        self.weights = [args.mix[name] for name in self.names]
+        # Earlier quote targets, reused with --repeat so render, file_id and LLM coalescing paths get exercised
+        self.targets: list[dict] = []
+        self.updates_sent = 0
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.outcomes: dict[str, dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.error_samples: dict[str, str] = {}
+
+    def pick_user(self) -> int:
+        # Even ids have a profile photo in the fake API, odd ones get the letter avatar
+        return self.random.randint(1, self.args.users)
+
+    def target_message(self, chat_id: int, index: int) -> tuple[dict, bool]:
+        reusable = [t for t in self.targets if t["chat"]["id"] == chat_id]
+        if reusable and self.random.random() < self.args.repeat:
+            return self.random.choice(reusable), False
+        text = f"{self.random.choice(SAMPLE_TEXTS)} #{index}"
+        target = self.fake.make_message(chat_id, self.pick_user(), text)
+        self.targets.append(target)
+        if len(self.targets) > 1000:
+            del self.targets[:500]
+        return target, True
+
+    async def push(self, message: dict) -> None:
+        self.updates_sent += 1
+        await self.fake.push_update(self.session, self.fake.make_update(message))
+
+    async def run_command(self, index: int) -> None:
+        name = self.random.choices(self.names, self.weights)[0]
+        chat_id = self.random.choice(self.chats)
+        target = None
+        if name in QUOTE_COMMANDS or (name == "roast" and self.random.random() < 0.5):
+            target, fresh = self.target_message(chat_id, index)
+            if fresh:
+                # Pushed as ordinary chat traffic first, like the message really being sent
+                await self.push(target)
+        if name == "mention":
+            text = f"@{BOT_USERNAME} {self.random.choice(SAMPLE_TEXTS)}"
+        else:
+            text = f"/{name}"
+        command = self.fake.make_message(chat_id, self.pick_user(), text, reply_to=target)
+
+        # Success replies go to the quoted message, errors and refusals to the command itself. Several commands
+        # can target one message, so replies to it are told apart by method (photo/sticker vs text)
+        waiters = [self.fake.expect_reply_to(chat_id, command["message_id"])]
+        if target:
+            methods = ("sendPhoto", "sendSticker") if name in QUOTE_COMMANDS else ("sendMessage",)
+            waiters.append(self.fake.expect_reply_to(chat_id, target["message_id"], methods))
+        start = time.perf_counter()
+        await self.push(command)
+        done, pending = await asyncio.wait(waiters, timeout=self.args.reply_timeout, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in pending:
+            waiter.cancel()
+        if not done:
+            self.outcomes[name]["timeout"] += 1
+            return
+        method, at, message = done.pop().result()
+        self.latencies[name].append(at - start)
+        text = (message or {}).get("text", "")
+        if name in QUOTE_COMMANDS:
+            ok = method in ("sendPhoto", "sendSticker")
+        else:
+            ok = FAKE_REPLY in text
+        self.outcomes[name]["ok" if ok else "error"] += 1
+        if not ok:
+            self.error_samples.setdefault(name, text)
+
+    async def run(self) -> float:
+        outstanding = asyncio.Semaphore(self.args.max_outstanding)
+        tasks = []
+
+        async def one(index: int) -> None:
+            try:
+                await self.run_command(index)
+            finally:
+                outstanding.release()
+
+        start = time.perf_counter()
+        for index in range(self.args.commands):
+            if self.args.rate:
+                # Open loop: commands go out on schedule whether or not earlier ones were answered
+                delay = start + index / self.args.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await outstanding.acquire()
+            tasks.append(asyncio.create_task(one(index)))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - start
+
+
+async def start_bot(main, args):
+    if args.mode == "webhook":
+        from webhook import serve_webhook
+        application = main.build_application()
+        url = f"http://127.0.0.1:{args.webhook_port}/telegram"
+        task = asyncio.create_task(serve_webhook(
+            application, listen="127.0.0.1", port=args.webhook_port, path="/telegram", webhook_url=url,
+            allowed_updates=main.ALLOWED_UPDATES,
+        ))
+
+        async def stop() -> None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        return application, stop
+
+    application = main.build_application()
+    await application.initialize()
+    await application.post_init(application)
+    await application.updater.start_polling(allowed_updates=main.ALLOWED_UPDATES, timeout=10)
+    await application.start()
+
+    async def stop() -> None:
+        await application.updater.stop()
+        await application.stop()
+        await application.post_shutdown(application)
+        await application.shutdown()
+    return application, stop
+
+
+async def run(args, workdir: str) -> dict:
+    import main
+    # main's basicConfig runs at import; quieten it, and httpx's line per request, before traffic starts
+    logging.getLogger().setLevel(args.log_level.upper())
+
+    # Never touch a real quotes_data.json: its migration renames the file
+    main.QUOTES_FILE = os.path.join(workdir, "quotes_data.json")
+    fake = FakeTelegram(TOKEN, latency=args.api_latency, upload_latency=args.upload_latency)
+    genai = FakeGenAI(latency=args.llm_latency, jitter=args.llm_jitter, failure_rate=args.llm_failure_rate,
+                      chunk_interval=args.llm_chunk_interval, seed=args.seed)
+    main.llm.set_sdk(genai)
+    fake_runner = await start_fake_telegram(fake, "127.0.0.1", args.api_port)
+    main.open_services()
+    application, stop_bot = await start_bot(main, args)
+    if args.mode == "webhook":
+        while not fake.webhook_url:
+            await asyncio.sleep(0.05)
+
+    lag = LoopLagMonitor()
+    lag_task = asyncio.create_task(lag.run())
+    try:
+        async with ClientSession() as session:
+            driver = LoadDriver(fake, session, args)
+            duration = await driver.run()
+    finally:
+        lag_task.cancel()
+        await stop_bot()
+        await fake_runner.cleanup()
+
+    commands = {}
+    for name in driver.names:
+        commands[name] = {**driver.outcomes[name], **summarize(driver.latencies[name])}
+        if name in driver.error_samples:
+            commands[name]["error_sample"] = driver.error_samples[name]
+    answered = sum(len(v) for v in driver.latencies.values())
+    return {
+        "mode": args.mode,
+        "duration_s": round(duration, 2),
+        "updates_sent": driver.updates_sent,
+        "updates_per_s": round(driver.updates_sent / duration, 1),
+        "commands_answered_per_s": round(answered / duration, 1),
+        "commands": commands,
+        "loop_lag": summarize(lag.samples),
+        "bot_api_calls": dict(fake.calls),
+        "upload_mb": round(fake.upload_bytes / 1e6, 2),
+        "llm": {
+            **main.llm_stats(),
+            "models": {name: {k: m[k] for k in ("calls", "errors", "timeouts")} for name, m in main.llm.metrics()["models"].items()},
+            "backend": genai.stats(),
+        },
+        "render_cache": main.render_cache.stats(),
+    }
+
+
+def print_report(report: dict) -> None:
+    print(f"\n{report['mode']}: {report['updates_sent']} updates in {report['duration_s']}s "
+          f"= {report['updates_per_s']} updates/s, {report['commands_answered_per_s']} commands answered/s")
+    print(f"\n{'command':<12}{'ok':>7}{'error':>7}{'timeout':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, row in report["commands"].items():
+        print(f"{name:<12}{row.get('ok', 0):>7}{row.get('error', 0):>7}{row.get('timeout', 0):>8}"
+              f"{row['p50_ms']:>10}{row['p90_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+    lag = report["loop_lag"]
+    print(f"\nevent loop lag: p50 {lag['p50_ms']} ms, p99 {lag['p99_ms']} ms, max {lag['max_ms']} ms")
+    print(f"bot api calls: {report['bot_api_calls']}, uploaded {report['upload_mb']} MB")
+    print(f"llm: {report['llm']}")
+    print(f"render cache: {report['render_cache']}")
+    for name, row in report["commands"].items():
+        if "error_sample" in row:
+            print(f"sample {name} error reply: {row['error_sample']!r}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline load test of the bot against fake Telegram and Gemini backends.")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--users", type=int, default=200, help="distinct senders across all chats")
+    parser.add_argument("--commands", type=int, default=500, help="commands to send (quoted messages are sent on top)")
+    parser.add_argument("--rate", type=float, default=50, help="commands per second; 0 sends as fast as --max-outstanding allows")
+    parser.add_argument("--max-outstanding", type=int, default=500, help="unanswered commands allowed at once")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("quote=4,quote_funny=2,roast=2,mention=2"),
+                        help="command weights, e.g. quote=4,roast=1")
+    parser.add_argument("--repeat", type=float, default=0.2, help="chance a quote/roast targets an already used message")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="seconds added to every fake Bot API call")
+    parser.add_argument("--upload-latency", type=float, default=0.05, help="extra seconds for photo/sticker uploads")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="mean fake Gemini latency in seconds")
+    parser.add_argument("--llm-jitter", type=float, default=0.5, help="latency spread as a fraction of the mean")
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0)
+    parser.add_argument("--llm-chunk-interval", type=float, default=0.15, help="seconds between streamed chunks")
+    parser.add_argument("--no-streaming", action="store_true", help="wait for whole LLM replies (LLM_STREAMING=0)")
+    parser.add_argument("--reply-timeout", type=float, default=60, help="seconds to wait for the first visible reply")
+    parser.add_argument("--keep-rate-limits", action="store_true", help="keep the per-chat/user LLM limits from the environment")
+    parser.add_argument("--api-port", type=int, default=18081)
+    parser.add_argument("--webhook-port", type=int, default=18080)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    # Configure the bot before main is imported; a real .env doesn't override these
+    workdir = tempfile.mkdtemp(prefix="quotebot-load-")
+    os.environ.update(
+        BOT_TOKEN=TOKEN,
+        GEMINI_API_KEY="fake",
+        TELEGRAM_API_URL=f"http://127.0.0.1:{args.api_port}",
+        QUOTES_DB=os.path.join(workdir, "quotes.db"),
+        CHAT_STATE_DB=os.path.join(workdir, "quotes.db"),
+        FILE_ID_DB=os.path.join(workdir, "quotes.db"),
+        RENDER_CACHE_DIR="",
+        METRICS_PORT="0",
+    )
+    if args.no_streaming:
+        os.environ["LLM_STREAMING"] = "0"
+    if not args.keep_rate_limits:
+        os.environ.update(CHAT_LLM_PER_MINUTE="1000000", CHAT_LLM_BURST="1000000",
+                          USER_LLM_PER_MINUTE="1000000", USER_LLM_BURST="1000000")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    try:
+        report = asyncio.run(run(args, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,61 +1,422 @@
+import time
+STARTED_AT = time.perf_counter()
+
 import os
+import math
+import html
 import logging
 import asyncio
-import json
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from io import BytesIO
+from typing import Optional
 from dotenv import load_dotenv
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from image_generator import create_quote_image
-import google.generativeai as genai
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes
+from image_generator import warm_fonts, prepare_avatar, validate_fonts, AVATAR_SIZE
+from render_pool import RenderPool, RenderBusyError
+from quote_store import QuoteStore
+from chat_state import ChatStateStore
+from chat_memory import ChatMemoryStore
+from image_encoder import OUTPUT_FORMATS, DEFAULT_FORMAT, is_sticker, file_extension
+from render_cache import RenderCache, FileIdStore, make_render_key, make_multi_render_key
+from avatar_cache import AvatarCache
+from theme_classifier import ThemeClassifier
+from llm_gateway import LLMGateway, LLMBusyError
+from rate_limit import RateLimiter
+from metrics import REGISTRY, instrument, stage, record_stage, set_trace_sample_rate, start_metrics_server
+from diagnostics import LoopWatchdog, profile_for, profiling, prune_profiles
+
+# (phase, perf_counter when it finished); reported once the first update arrives
+startup_marks = [("imports", time.perf_counter())]
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS") or "0")
+RENDER_WORKER_KIND = os.getenv("RENDER_WORKER_KIND", "process")
+RENDER_QUEUE_SIZE = int(os.getenv("RENDER_QUEUE_SIZE", "0"))
+QUOTES_DB = os.getenv("QUOTES_DB", "quotes.db")
+RENDER_CACHE_MB = int(os.getenv("RENDER_CACHE_MB", "64"))
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR") or None
+FILE_ID_DB = os.getenv("FILE_ID_DB") or QUOTES_DB
+FILE_ID_CACHE_SIZE = int(os.getenv("FILE_ID_CACHE_SIZE", "10000"))
+AVATAR_CACHE_TTL = float(os.getenv("AVATAR_CACHE_TTL", "3600"))
+AVATAR_CACHE_SIZE = int(os.getenv("AVATAR_CACHE_SIZE", "2048"))
+THEME_CACHE_SIZE = int(os.getenv("THEME_CACHE_SIZE", "4096"))
+AVATAR_TIMEOUT = float(os.getenv("AVATAR_TIMEOUT", "3"))
+THEME_TIMEOUT = float(os.getenv("THEME_TIMEOUT", "4"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_PER_CHAT_CONCURRENCY = int(os.getenv("LLM_PER_CHAT_CONCURRENCY", "2"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "64"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "5"))
+CHAT_LLM_PER_MINUTE = float(os.getenv("CHAT_LLM_PER_MINUTE", "20"))
+CHAT_LLM_BURST = int(os.getenv("CHAT_LLM_BURST", "10"))
+USER_LLM_PER_MINUTE = float(os.getenv("USER_LLM_PER_MINUTE", "6"))
+USER_LLM_BURST = int(os.getenv("USER_LLM_BURST", "3"))
+LLM_STREAMING = os.getenv("LLM_STREAMING", "1") != "0"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+STREAM_EDITS_PER_MINUTE = float(os.getenv("STREAM_EDITS_PER_MINUTE", "20"))
+RECENT_MESSAGES_PER_CHAT = int(os.getenv("RECENT_MESSAGES_PER_CHAT", "50"))
+RECENT_MESSAGES_IDLE_HOURS = float(os.getenv("RECENT_MESSAGES_IDLE_HOURS", "24"))
+RECENT_MESSAGES_MAX_CHATS = int(os.getenv("RECENT_MESSAGES_MAX_CHATS", "10000"))
+MAX_QUOTE_MESSAGES = 10
+QUOTE_FORMAT = os.getenv("QUOTE_FORMAT", DEFAULT_FORMAT)
+DEPLOY_MODE = os.getenv("DEPLOY_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+CHAT_MEMORY_TURNS = int(os.getenv("CHAT_MEMORY_TURNS", "30"))
+CHAT_MEMORY_TOKENS = int(os.getenv("CHAT_MEMORY_TOKENS", "600"))
+CHAT_MEMORY_SUMMARY_TOKENS = int(os.getenv("CHAT_MEMORY_SUMMARY_TOKENS", "150"))
+CHAT_MEMORY_IDLE_HOURS = float(os.getenv("CHAT_MEMORY_IDLE_HOURS", "6"))
+CHAT_MEMORY_ENGAGED_MINUTES = float(os.getenv("CHAT_MEMORY_ENGAGED_MINUTES", "30"))
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.25"))
+ADMIN_USER_IDS = {int(i) for i in os.getenv("ADMIN_USER_IDS", "").replace(",", " ").split()}
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SECONDS = float(os.getenv("PROFILE_SECONDS", "30"))
+PROFILE_INTERVAL_MINUTES = float(os.getenv("PROFILE_INTERVAL_MINUTES", "0"))
+CHAT_STATE_DB = os.getenv("CHAT_STATE_DB", QUOTES_DB)
+CHAT_STATE_FLUSH_INTERVAL = float(os.getenv("CHAT_STATE_FLUSH_INTERVAL", "1"))
+
+# Telegram rejects longer texts
+MAX_MESSAGE_CHARS = 4096
+
+# Handlers only read messages, plus button presses on /quotes pages
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+QUOTES_PAGE_SIZE = 10
+QUOTE_PREVIEW_CHARS = 300
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
-# Global state to store the bot's current character
-bot_state = {
-    "character": "genz",
-    "glaze_list": set()
-}
-
 QUOTES_FILE = "quotes_data.json"
 
-def load_quotes():
-    if os.path.exists(QUOTES_FILE):
-        try:
-            with open(QUOTES_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"Failed to load quotes: {e}")
-    return {}
+# chat_id -> deque of (message_id, user_id, display name, text, date), newest last; least recently active chat first
+recent_messages: OrderedDict[int, deque] = OrderedDict()
+
+render_pool = RenderPool(workers=RENDER_WORKERS, kind=RENDER_WORKER_KIND, max_pending=RENDER_QUEUE_SIZE)
+render_cache = RenderCache(max_bytes=RENDER_CACHE_MB * 1024 * 1024, spill_dir=RENDER_CACHE_DIR)
+avatar_cache = AvatarCache(ttl=AVATAR_CACHE_TTL, max_entries=AVATAR_CACHE_SIZE)
+llm = LLMGateway(
+    api_key=GEMINI_API_KEY, max_concurrency=LLM_MAX_CONCURRENCY, per_chat_concurrency=LLM_PER_CHAT_CONCURRENCY,
+    timeout=LLM_TIMEOUT, max_pending=LLM_QUEUE_SIZE, queue_timeout=LLM_QUEUE_TIMEOUT,
+)
+loop_watchdog = LoopWatchdog(threshold=LOOP_STALL_THRESHOLD)
+chat_llm_limit = RateLimiter(CHAT_LLM_PER_MINUTE, CHAT_LLM_BURST)
+user_llm_limit = RateLimiter(USER_LLM_PER_MINUTE, USER_LLM_BURST)
+# Edits count against the chat's Telegram flood limit, so streamed replies in one chat share a budget
+stream_edit_limit = RateLimiter(STREAM_EDITS_PER_MINUTE, 3)
+
+_quote_store = None
+
+def get_quote_store() -> QuoteStore:
+    global _quote_store
+    if _quote_store is None:
+        _quote_store = QuoteStore(QUOTES_DB)
+        _quote_store.migrate_json(QUOTES_FILE)
+    return _quote_store
 
 def save_quote(chat_id, name, text):
-    quotes_db = load_quotes()
-    chat_id_str = str(chat_id)
-    if chat_id_str not in quotes_db:
-        quotes_db[chat_id_str] = []
-        
-    for q in quotes_db[chat_id_str]:
-        if q["text"] == text and q["name"] == name:
-            return
-            
-    quotes_db[chat_id_str].append({"name": name, "text": text})
     try:
-        with open(QUOTES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(quotes_db, f, ensure_ascii=False, indent=4)
+        with stage("save_quote"):
+            get_quote_store().add(chat_id, name, text)
     except Exception as e:
         logger.error(f"Failed to save quotes: {e}")
 
-def get_character_prompt() -> str:
-    char = bot_state["character"]
+_chat_state = None
+
+def get_chat_state() -> ChatStateStore:
+    global _chat_state
+    if _chat_state is None:
+        _chat_state = ChatStateStore(CHAT_STATE_DB, flush_interval=CHAT_STATE_FLUSH_INTERVAL)
+    return _chat_state
+
+_file_id_store = None
+
+def get_file_id_store() -> FileIdStore:
+    global _file_id_store
+    if _file_id_store is None:
+        _file_id_store = FileIdStore(FILE_ID_DB, max_entries=FILE_ID_CACHE_SIZE)
+    return _file_id_store
+
+async def ask_theme_model(prompt: str) -> str:
+    try:
+        return (await llm.generate(prompt)).strip().lower()
+    except Exception as e:
+        logger.error(f"Theme classification error: {e}")
+        return ""
+
+theme_classifier = ThemeClassifier(ask_theme_model, max_entries=THEME_CACHE_SIZE)
+
+async def summarize_chat(chat_id: int, prompt: str) -> Optional[str]:
+    # Summaries spend the chat's LLM budget and only use spare capacity, so they never cost a reply its slot
+    if chat_llm_limit.wait_time(chat_id):
+        return None
+    try:
+        summary = await llm.generate(prompt, chat_id=chat_id, background=True)
+    except LLMBusyError:
+        # Nothing was sent, so nothing is charged; the store tries again later
+        return None
+    except Exception:
+        chat_llm_limit.take(chat_id)
+        raise
+    chat_llm_limit.take(chat_id)
+    return summary
+
+chat_memory = ChatMemoryStore(
+    summarize=summarize_chat if GEMINI_API_KEY else None,
+    max_turns=CHAT_MEMORY_TURNS,
+    token_budget=CHAT_MEMORY_TOKENS,
+    summary_tokens=CHAT_MEMORY_SUMMARY_TOKENS,
+    idle_ttl=CHAT_MEMORY_IDLE_HOURS * 3600,
+    engaged_ttl=CHAT_MEMORY_ENGAGED_MINUTES * 60,
+)
+
+async def fetch_avatar(bot, user_id) -> Optional[bytes]:
+    photos = await bot.get_user_profile_photos(user_id, limit=1)
+    if not photos.photos:
+        return None
+    # Sizes are ordered small to large; the smallest one that still covers the avatar saves bandwidth and resize work
+    sizes = photos.photos[0]
+    photo = next((p for p in sizes if min(p.width, p.height) >= AVATAR_SIZE[0]), sizes[-1])
+    photo_file = await bot.get_file(photo.file_id)
+    byte_array = await photo_file.download_as_bytearray()
+    return await render_pool.run(prepare_avatar, bytes(byte_array))
+
+async def get_avatar(bot, user_id) -> Optional[bytes]:
+    try:
+        return await avatar_cache.get(user_id, lambda: fetch_avatar(bot, user_id))
+    except Exception as e:
+        logger.error(f"Error fetching avatar: {e}")
+        return None
+
+async def render_cached(key, render, output_format) -> BytesIO:
+    data = render_cache.get(key)
+    if data is None:
+        quote_img = await render()
+        render_cache.put(key, quote_img.getvalue())
+    else:
+        quote_img = BytesIO(data)
+    quote_img.name = f"quote.{file_extension(output_format)}"
+    return quote_img
+
+async def send_quote_file(context, chat_id, reply_to_message_id, media, output_format):
+    if is_sticker(output_format):
+        sent = await context.bot.send_sticker(chat_id=chat_id, sticker=media, reply_to_message_id=reply_to_message_id)
+        return sent.sticker.file_id if sent.sticker else None
+    sent = await context.bot.send_photo(chat_id=chat_id, photo=media, reply_to_message_id=reply_to_message_id)
+    return sent.photo[-1].file_id if sent.photo else None
+
+async def send_quote(context, chat_id, reply_to_message_id, key, render, output_format=DEFAULT_FORMAT) -> None:
+    file_ids = get_file_id_store()
+
+    file_id = file_ids.get(key)
+    if file_id:
+        try:
+            with stage("send_cached"):
+                await send_quote_file(context, chat_id, reply_to_message_id, file_id, output_format)
+            return
+        except BadRequest as e:
+            logger.warning(f"Cached file_id rejected, re-uploading: {e}")
+            file_ids.discard(key)
+
+    with stage("render"):
+        quote_img = await render_cached(key, render, output_format)
+    with stage("upload"):
+        new_file_id = await send_quote_file(context, chat_id, reply_to_message_id, quote_img, output_format)
+    if new_file_id:
+        file_ids.put(key, new_file_id)
+
+async def run_stage(stage_name, aw, timeout, fallback):
+    # A slow or failing stage degrades to its fallback instead of holding up the quote
+    try:
+        with stage(stage_name):
+            return await asyncio.wait_for(aw, timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Quote stage '{stage_name}' timed out after {timeout}s, using fallback")
+    except Exception as e:
+        logger.error(f"Quote stage '{stage_name}' failed: {e}")
+    return fallback
+
+def display_name(user) -> str:
+    name = user.first_name
+    if user.last_name:
+        name += f" {user.last_name}"
+    return name
+
+async def build_and_send_quote(context, message, target_msg, themed: bool, output_format: str) -> None:
+    sender = target_msg.from_user
+    name = display_name(sender)
+    text = target_msg.text
+    time_text = datetime.now().strftime("%H:%M")
+
+    # Avatar and theme keep running in the background on timeout so their caches still fill
+    stages = [run_stage("avatar", asyncio.shield(get_avatar(context.bot, sender.id)), AVATAR_TIMEOUT, None)]
+    if themed and GEMINI_API_KEY:
+        stages.append(run_stage("theme", asyncio.shield(theme_classifier.classify(text)), THEME_TIMEOUT, "default"))
+    results = await asyncio.gather(*stages)
+    avatar_bytes = results[0]
+    theme = results[1] if len(results) > 1 else "default"
+
+    # The key needs no layout: cached file_ids and renders skip Pillow, and a miss lays out inside the render worker
+    key = make_render_key(avatar_bytes, name, text, theme, time_text, output_format)
+    render = lambda: render_pool.render_quote(avatar_bytes, name, text, theme, time_text, output_format=output_format)
+    await send_quote(context, message.chat_id, target_msg.message_id, key, render, output_format)
+    save_quote(message.chat_id, name, text)
+
+async def build_and_send_multi_quote(context, message, picked, output_format: str) -> None:
+    sender_ids = list(dict.fromkeys(m[1] for m in picked))
+    avatars = await asyncio.gather(*[
+        run_stage("avatar", asyncio.shield(get_avatar(context.bot, user_id)), AVATAR_TIMEOUT, None)
+        for user_id in sender_ids
+    ])
+    avatar_by_sender = dict(zip(sender_ids, avatars))
+
+    messages = [
+        {"avatar": avatar_by_sender[user_id], "name": name, "text": text, "time_text": date.astimezone().strftime("%H:%M"), "sender": user_id}
+        for _, user_id, name, text, date in picked
+    ]
+    key = make_multi_render_key(messages, "default", output_format)
+    render = lambda: render_pool.render_multi_quote(messages, "default", output_format)
+    await send_quote(context, message.chat_id, picked[0][0], key, render, output_format)
+    for m in messages:
+        save_quote(message.chat_id, m["name"], m["text"])
+
+async def remember_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    message = update.message
+    if not message or not message.text or not message.from_user:
+        return
+    buf = recent_messages.get(message.chat_id)
+    if buf is None:
+        buf = recent_messages[message.chat_id] = deque(maxlen=RECENT_MESSAGES_PER_CHAT)
+    else:
+        recent_messages.move_to_end(message.chat_id)
+    buf.append((message.message_id, message.from_user.id, display_name(message.from_user), message.text, message.date))
+    # Forget chats nobody has written in for a while; a chat's newest message date says when it was last active
+    while recent_messages:
+        oldest = next(iter(recent_messages.values()))
+        if (len(recent_messages) <= RECENT_MESSAGES_MAX_CHATS
+                and (message.date - oldest[-1][4]).total_seconds() < RECENT_MESSAGES_IDLE_HOURS * 3600):
+            break
+        recent_messages.popitem(last=False)
+    chat_memory.add(message.chat_id, display_name(message.from_user), message.text, message.message_id)
+
+async def allow_llm(message, notify: bool = True) -> bool:
+    # Both buckets are checked before either is charged, so a refused request costs nothing
+    user_id = message.from_user.id
+    user_wait = user_llm_limit.wait_time(user_id)
+    chat_wait = chat_llm_limit.wait_time(message.chat_id)
+    if not user_wait and not chat_wait:
+        user_llm_limit.take(user_id)
+        chat_llm_limit.take(message.chat_id)
+        return True
+    limiter, key = (user_llm_limit, user_id) if user_wait >= chat_wait else (chat_llm_limit, message.chat_id)
+    if notify and limiter.refuse(key):
+        wait = max(user_wait, chat_wait)
+        if math.isinf(wait):
+            # A rate of 0 switches LLM replies off
+            text = "My AI brain is switched off here, no cap."
+        else:
+            text = f"Slow down, my brain cell needs {math.ceil(wait)}s to recharge."
+        await message.reply_text(text, reply_to_message_id=message.message_id)
+    return False
+
+def llm_chunks(prompt: str, chat_id):
+    if LLM_STREAMING:
+        return llm.stream(prompt, chat_id=chat_id)
+
+    async def whole():
+        yield await llm.generate(prompt, chat_id=chat_id)
+    return whole()
+
+async def edit_streamed(sent, text: str, final: bool) -> bool:
+    chat_id = sent.chat_id
+    wait = stream_edit_limit.wait_time(chat_id)
+    if wait:
+        if not final or math.isinf(wait):
+            return False
+        await asyncio.sleep(wait)
+    stream_edit_limit.take(chat_id)
+    for attempt in range(2):
+        try:
+            with stage("edit"):
+                await sent.edit_text(text[:MAX_MESSAGE_CHARS])
+            return True
+        except RetryAfter as e:
+            # Intermediate edits just skip a beat; the final one waits once so the full text lands
+            if not final or attempt:
+                return False
+            retry = e.retry_after
+            await asyncio.sleep(retry.total_seconds() if isinstance(retry, timedelta) else retry)
+        except TelegramError as e:
+            logger.warning(f"Streamed reply edit failed: {e}")
+            return False
+    return False
+
+async def reply_streamed(message, chunks, reply_to_message_id: int, prefix: str = "", empty_text: str = "") -> str:
+    # The first chunk goes out as soon as it arrives and the rest lands through throttled edits.
+    # If the stream breaks off after that, the partial reply stays up instead of an error message.
+    start = time.perf_counter()
+    text = ""
+    sent = None
+    last_edit = 0.0
+    # Edits run beside the stream, at most one at a time, so a slow edit never holds the LLM slot
+    edit = None
+    edited_len = 0
+    try:
+        async for chunk in chunks:
+            text += chunk
+            if sent is None:
+                if not text.strip():
+                    continue
+                record_stage("first_chunk", time.perf_counter() - start)
+                with stage("reply"):
+                    sent = await message.reply_text((prefix + text)[:MAX_MESSAGE_CHARS], reply_to_message_id=reply_to_message_id)
+                edited_len = len(text)
+                last_edit = time.monotonic()
+            elif time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL and (edit is None or edit.done()):
+                edit = asyncio.ensure_future(edit_streamed(sent, prefix + text, final=False))
+                edited_len = len(text)
+                last_edit = time.monotonic()
+    except Exception as e:
+        if sent is None:
+            raise
+        logger.error(f"LLM stream failed after {len(text)} chars, keeping the partial reply: {e}")
+
+    if sent is None:
+        text = empty_text
+        with stage("reply"):
+            await message.reply_text(prefix + text, reply_to_message_id=reply_to_message_id)
+        return text
+    if edit is not None and not await edit:
+        edited_len = -1
+    if len(text) != edited_len:
+        await edit_streamed(sent, prefix + text, final=True)
+    return text
+
+def pick_recent_messages(chat_id, count, start_message_id=None) -> list[tuple]:
+    buf = list(recent_messages.get(chat_id, ()))
+    if start_message_id is None:
+        return buf[-count:]
+    for i, m in enumerate(buf):
+        if m[0] == start_message_id:
+            return buf[i:i + count]
+    return []
+
+def get_character_prompt(char: str) -> str:
     if char == "chill guy":
         return 'a super "chill guy". You are completely unfazed by everything. You speak calmly, shortly, use phrases like "it is what it is", "chill", "no sweat", "whatever bro". You are practically horizontal you are so relaxed.'
     elif char == "science":
@@ -70,8 +431,25 @@ def get_character_prompt() -> str:
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("Hi there! I generate stylish quotes and I can roast your friends. Tag me or reply to a message with /quote to start.")
 
+def parse_quote_args(chat_id, args) -> tuple[int, str]:
+    # "/quote [N] [format]" in any order; the chat's /quote_format choice is the default
+    count = 1
+    output_format = get_chat_state().get(chat_id).quote_format or QUOTE_FORMAT
+    for arg in args or []:
+        if arg.isdigit():
+            count = min(max(int(arg), 1), MAX_QUOTE_MESSAGES)
+        elif arg.lower() in OUTPUT_FORMATS:
+            output_format = arg.lower()
+    return count, output_format
+
+@instrument("quote")
 async def quote(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = update.message
+    count, output_format = parse_quote_args(message.chat_id, context.args)
+    if count > 1:
+        await quote_many(update, context, count, output_format)
+        return
+
     if not message.reply_to_message:
         await message.reply_text("Bruh, reply to a message with /quote if you want me to do my job.", reply_to_message_id=message.message_id)
         return
@@ -81,37 +459,36 @@ async def quote(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await message.reply_text("I only quote texts, not silence.", reply_to_message_id=message.message_id)
         return
 
-    sender = target_msg.from_user
-    name = sender.first_name
-    if sender.last_name:
-        name += f" {sender.last_name}"
-        
-    text = target_msg.text
-    
-    avatar_bytes = None
     try:
-        photos = await context.bot.get_user_profile_photos(sender.id, limit=1)
-        if photos.photos:
-            photo_file = await context.bot.get_file(photos.photos[0][-1].file_id)
-            byte_array = await photo_file.download_as_bytearray()
-            avatar_bytes = bytes(byte_array)
+        await build_and_send_quote(context, message, target_msg, themed=False, output_format=output_format)
+    except RenderBusyError as e:
+        logger.warning(f"Render queue full: {e}")
+        await message.reply_text("Too many quotes cooking rn, try again in a sec.", reply_to_message_id=message.message_id)
     except Exception as e:
-        logger.error(f"Error fetching avatar: {e}")
+        logger.error(f"Error generating quote: {e}")
+        await message.reply_text("My quoting machine broke down, RIP.", reply_to_message_id=message.message_id)
+
+async def quote_many(update: Update, context: ContextTypes.DEFAULT_TYPE, count: int, output_format: str) -> None:
+    message = update.message
+    start_id = message.reply_to_message.message_id if message.reply_to_message else None
+    picked = pick_recent_messages(message.chat_id, count, start_id)
+    if not picked:
+        await message.reply_text("I don't remember those messages, I only keep the recent ones. Try a newer message.", reply_to_message_id=message.message_id)
+        return
 
     try:
-        quote_img = create_quote_image(avatar_bytes, name, text)
-        await context.bot.send_photo(
-            chat_id=message.chat_id,
-            photo=quote_img,
-            reply_to_message_id=target_msg.message_id
-        )
-        save_quote(message.chat_id, name, text)
+        await build_and_send_multi_quote(context, message, picked, output_format)
+    except RenderBusyError as e:
+        logger.warning(f"Render queue full: {e}")
+        await message.reply_text("Too many quotes cooking rn, try again in a sec.", reply_to_message_id=message.message_id)
     except Exception as e:
-        logger.error(f"Error generating quote: {e}")
+        logger.error(f"Error generating multi-message quote: {e}")
         await message.reply_text("My quoting machine broke down, RIP.", reply_to_message_id=message.message_id)
 
+@instrument("quote_funny")
 async def quote_funny(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = update.message
+    _, output_format = parse_quote_args(message.chat_id, context.args)
     if not message.reply_to_message:
         await message.reply_text("Bruh, reply to a message with /quote_funny if you want a themed quote.", reply_to_message_id=message.message_id)
         return
@@ -121,57 +498,18 @@ async def quote_funny(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await message.reply_text("I only quote texts, not silence.", reply_to_message_id=message.message_id)
         return
 
-    sender = target_msg.from_user
-    name = sender.first_name
-    if sender.last_name:
-        name += f" {sender.last_name}"
-        
-    text = target_msg.text
-    
-    theme = "default"
-    if GEMINI_API_KEY:
-        prompt = f"Analyze this text and strictly classify it into EXACTLY ONE of these categories: sigma, hacker, romantic, hustle, spooky, sad, default. Output just the category word in lowercase. Text: '{text}'"
-        try:
-            model = genai.GenerativeModel("gemini-3-flash-preview")
-            response = await model.generate_content_async(prompt)
-            result = response.text.strip().lower()
-        except Exception:
-            try:
-                model = genai.GenerativeModel("gemini-2.5-flash")
-                response = await model.generate_content_async(prompt)
-                result = response.text.strip().lower()
-            except Exception as e:
-                logger.error(f"Theme classification error: {e}")
-                result = ""
-
-        if result:
-            for t in ["sigma", "hacker", "romantic", "hustle", "spooky", "sad"]:
-                if t in result:
-                    theme = t
-                    break
-
-    avatar_bytes = None
-    try:
-        photos = await context.bot.get_user_profile_photos(sender.id, limit=1)
-        if photos.photos:
-            photo_file = await context.bot.get_file(photos.photos[0][-1].file_id)
-            byte_array = await photo_file.download_as_bytearray()
-            avatar_bytes = bytes(byte_array)
-    except Exception as e:
-        logger.error(f"Error fetching avatar: {e}")
-
+    # Over the limit the quote still goes out, just without the LLM-picked theme
+    themed = await allow_llm(message, notify=False)
     try:
-        quote_img = create_quote_image(avatar_bytes, name, text, theme)
-        await context.bot.send_photo(
-            chat_id=message.chat_id,
-            photo=quote_img,
-            reply_to_message_id=target_msg.message_id
-        )
-        save_quote(message.chat_id, name, text)
+        await build_and_send_quote(context, message, target_msg, themed=themed, output_format=output_format)
+    except RenderBusyError as e:
+        logger.warning(f"Render queue full: {e}")
+        await message.reply_text("Too many quotes cooking rn, try again in a sec.", reply_to_message_id=message.message_id)
     except Exception as e:
         logger.error(f"Error generating themed quote: {e}")
         await message.reply_text("My quoting machine broke down, RIP.", reply_to_message_id=message.message_id)
 
+@instrument("handle_message")
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = update.message
     if not message or not message.text:
@@ -194,16 +532,20 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if not GEMINI_API_KEY:
         await message.reply_text("My AI brain is offline, missing API key no cap.", reply_to_message_id=message.message_id)
         return
+    if not await allow_llm(message):
+        return
+    chat_memory.engage(message.chat_id)
 
     user = message.from_user
     username = f"@{user.username}".lower() if user.username else "No Username"
     first_name = user.first_name or "Unknown"
     
-    is_vip = username in bot_state["glaze_list"]
+    state = get_chat_state().get(message.chat_id)
+    is_vip = username in state.vips
     
     glaze_string = ""
-    if bot_state["glaze_list"]:
-        glaze_string = f"VIPs: {', '.join(bot_state['glaze_list'])}"
+    if state.vips:
+        glaze_string = f"VIPs: {', '.join(sorted(state.vips))}"
     
     context_msgs = []
     if message.reply_to_message:
@@ -213,7 +555,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         r_text = reply_msg.text or "[Media]"
         context_msgs.append(f"Replying to {r_name} who said: '{r_text}'")
 
-    char_prompt = get_character_prompt()
+    char_prompt = get_character_prompt(state.character)
     
     base_prompt = f"You are {char_prompt}\n\n"
     
@@ -233,6 +575,12 @@ Current Interaction details:
 - Is this user a VIP? No VIP list is currently active.
 """
 
+    summary, recent_chat = chat_memory.context(message.chat_id, exclude_message_id=message.message_id)
+    if summary:
+        base_prompt += f"\nWhat happened earlier in this chat: {summary}\n"
+    if recent_chat:
+        base_prompt += f"\nRecent messages in this chat (oldest first, \"You\" is you):\n{recent_chat}\n\n"
+
     prompt = base_prompt + f"""- Context: {' | '.join(context_msgs) if context_msgs else 'None'}
 - Their message to you: "{message.text}"
 
@@ -240,29 +588,27 @@ Respond naturally in character. Keep it punchy and engaging! If defending a VIP,
 """
     
     try:
-        model = genai.GenerativeModel("gemini-3-flash-preview")
         await context.bot.send_chat_action(chat_id=message.chat_id, action="typing")
-        response = await model.generate_content_async(prompt)
-        
-        reply_text = response.text
-        if not reply_text:
-            reply_text = "I literally have zero words for this. L."
-            
-        await message.reply_text(reply_text, reply_to_message_id=message.message_id)
+        with stage("llm"):
+            reply_text = await reply_streamed(
+                message, llm_chunks(prompt, message.chat_id), message.message_id,
+                empty_text="I literally have zero words for this. L.",
+            )
+        chat_memory.add(message.chat_id, "You", reply_text)
+    except LLMBusyError as e:
+        logger.warning(f"LLM overloaded: {e}")
+        await message.reply_text("Too many people yapping at me rn, try again in a sec.", reply_to_message_id=message.message_id)
     except Exception as e:
         logger.error(f"GenAI Error in handle_message: {e}")
-        try:
-            model = genai.GenerativeModel("gemini-2.5-flash")
-            response = await model.generate_content_async(prompt)
-            await message.reply_text(response.text, reply_to_message_id=message.message_id)
-        except Exception as e2:
-            logger.error(f"GenAI Fallback Error in handle_message: {e2}")
-            await message.reply_text("My brain literally crashed. BRB getting a factory reset. RIP.", reply_to_message_id=message.message_id)
+        await message.reply_text("My brain literally crashed. BRB getting a factory reset. RIP.", reply_to_message_id=message.message_id)
 
+@instrument("roast_cmd")
 async def roast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not GEMINI_API_KEY:
         await update.message.reply_text("Need API key to roast.", reply_to_message_id=update.message.message_id)
         return
+    if not await allow_llm(update.message):
+        return
         
     target = update.message.from_user
     context_msgs = "Roast the user."
@@ -275,7 +621,7 @@ async def roast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     name = getattr(target, 'first_name', 'Unknown')
     username = f"@{target.username}" if target.username else "No Username"
     
-    is_vip_roast = (target.username and f"@{target.username.lower()}" in bot_state["glaze_list"])
+    is_vip_roast = (target.username and f"@{target.username.lower()}" in get_chat_state().get(update.message.chat_id).vips)
     
     if is_vip_roast:
         await update.message.reply_text(f"I would never roast my VIP! They are literally perfect. How dare you even try? L + Ratio.", reply_to_message_id=reply_target_id)
@@ -285,24 +631,26 @@ async def roast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     mention_prefix = f"{username}, " if target.username else f"{name}, "
     
     try:
-        model = genai.GenerativeModel("gemini-3-flash-preview")
         await context.bot.send_chat_action(chat_id=update.message.chat_id, action="typing")
-        response = await model.generate_content_async(prompt)
-        await update.message.reply_text(mention_prefix + response.text, reply_to_message_id=reply_target_id)
+        with stage("llm"):
+            await reply_streamed(
+                update.message, llm_chunks(prompt, update.message.chat_id), reply_target_id,
+                prefix=mention_prefix, empty_text="Too mid to roast.",
+            )
+    except LLMBusyError as e:
+        logger.warning(f"LLM overloaded: {e}")
+        await update.message.reply_text("Too many people yapping at me rn, try again in a sec.", reply_to_message_id=update.message.message_id)
     except Exception as e:
         logger.error(f"GenAI Error in roast: {e}")
-        try:
-            model = genai.GenerativeModel("gemini-2.5-flash")
-            response = await model.generate_content_async(prompt)
-            await update.message.reply_text(mention_prefix + response.text, reply_to_message_id=reply_target_id)
-        except Exception as e2:
-            logger.error(f"GenAI Fallback Error in roast: {e2}")
-            await update.message.reply_text(f"{mention_prefix}Too mid to roast.", reply_to_message_id=reply_target_id)
+        await update.message.reply_text(f"{mention_prefix}Too mid to roast.", reply_to_message_id=reply_target_id)
 
+@instrument("rizz_cmd")
 async def rizz_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not GEMINI_API_KEY:
         await update.message.reply_text("Need API key.", reply_to_message_id=update.message.message_id)
         return
+    if not await allow_llm(update.message):
+        return
         
     target_user_obj_or_str = "me"
     target_username_str = ""
@@ -316,19 +664,18 @@ async def rizz_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     prompt = f"You are a Gen-Z bot. Generate a flawless, smooth 'rizz' line for {target_user_obj_or_str}. Make it modern slang, witty, and either incredibly smooth or ironically corny. Keep it relatively short."
     
     try:
-        model = genai.GenerativeModel("gemini-3-flash-preview")
         await context.bot.send_chat_action(chat_id=update.message.chat_id, action="typing")
-        response = await model.generate_content_async(prompt)
-        await update.message.reply_text(target_username_str + response.text, reply_to_message_id=reply_target_id)
+        with stage("llm"):
+            await reply_streamed(
+                update.message, llm_chunks(prompt, update.message.chat_id), reply_target_id,
+                prefix=target_username_str, empty_text="My rizz algorithm failed.",
+            )
+    except LLMBusyError as e:
+        logger.warning(f"LLM overloaded: {e}")
+        await update.message.reply_text("Too many people yapping at me rn, try again in a sec.", reply_to_message_id=update.message.message_id)
     except Exception as e:
         logger.error(f"GenAI Error in rizz: {e}")
-        try:
-            model = genai.GenerativeModel("gemini-2.5-flash")
-            response = await model.generate_content_async(prompt)
-            await update.message.reply_text(target_username_str + response.text, reply_to_message_id=reply_target_id)
-        except Exception as e2:
-            logger.error(f"GenAI Fallback Error in rizz: {e2}")
-            await update.message.reply_text(f"{target_username_str}My rizz algorithm failed.", reply_to_message_id=reply_target_id)
+        await update.message.reply_text(f"{target_username_str}My rizz algorithm failed.", reply_to_message_id=reply_target_id)
 
 async def character_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     args = context.args
@@ -349,7 +696,7 @@ async def character_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     valid_chars = ["chill guy", "science", "slay bitch", "british esdeekid", "genz"]
     
     if new_char in valid_chars:
-        bot_state["character"] = new_char
+        get_chat_state().set_character(update.message.chat_id, new_char)
         await update.message.reply_text(f"Alright! I am now acting as the **{new_char}** character.", reply_to_message_id=update.message.message_id, parse_mode='Markdown')
     else:
         await update.message.reply_text(f"Invalid character '{new_char}'. Valid options: " + ", ".join(valid_chars), reply_to_message_id=update.message.message_id)
@@ -360,44 +707,269 @@ async def glaze_on_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if not username:
         await update.message.reply_text("You need a Telegram username to be glazed!", reply_to_message_id=update.message.message_id)
         return
-    bot_state["glaze_list"].add(username)
+    get_chat_state().add_vip(update.message.chat_id, username)
     await update.message.reply_text(f"Glaze mode ON for {username}! I will now aggressively praise and defend you.", reply_to_message_id=update.message.message_id)
 
 async def glaze_off_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.message.from_user
     username = f"@{user.username}".lower() if user.username else None
-    if username in bot_state["glaze_list"]:
-        bot_state["glaze_list"].remove(username)
+    if username:
+        get_chat_state().remove_vip(update.message.chat_id, username)
     await update.message.reply_text(f"Glaze mode OFF. I will no longer treat you as a VIP.", reply_to_message_id=update.message.message_id)
 
+async def quote_format_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.message.chat_id
+    if not context.args:
+        current = get_chat_state().get(chat_id).quote_format or QUOTE_FORMAT
+        await update.message.reply_text(
+            f"Quote format here is `{current}`. Options: " + ", ".join(f"`{f}`" for f in OUTPUT_FORMATS),
+            reply_to_message_id=update.message.message_id, parse_mode='Markdown'
+        )
+        return
+
+    new_format = context.args[0].lower()
+    if new_format not in OUTPUT_FORMATS:
+        await update.message.reply_text(f"Unknown format '{new_format}'. Options: " + ", ".join(OUTPUT_FORMATS), reply_to_message_id=update.message.message_id)
+        return
+    get_chat_state().set_quote_format(chat_id, new_format)
+    await update.message.reply_text(f"Quotes in this chat will now come out as `{new_format}`.", reply_to_message_id=update.message.message_id, parse_mode='Markdown')
+
+# browse id -> (chat_id, search terms, name filter, title); button callback_data only has room for the id
+quote_browsers: OrderedDict[int, tuple] = OrderedDict()
+_next_browse_id = 0
+
+def open_quote_browser(chat_id, search: str, by: str, title: str) -> int:
+    global _next_browse_id
+    _next_browse_id += 1
+    quote_browsers[_next_browse_id] = (chat_id, search, by, title)
+    while len(quote_browsers) > 1000:
+        quote_browsers.popitem(last=False)
+    return _next_browse_id
+
+def format_quotes_page(title: str, quotes: list[dict]) -> str:
+    # Previews are capped so a full page always fits in one 4096-character message
+    lines = [f"📜 <b>{html.escape(title)}</b>", ""]
+    for q in quotes:
+        text = q["text"] if len(q["text"]) <= QUOTE_PREVIEW_CHARS else q["text"][:QUOTE_PREVIEW_CHARS - 1] + "…"
+        lines.append(f"<i>{html.escape(q['name'][:64])}</i>: \"{html.escape(text)}\"")
+    return "\n".join(lines)
+
+def quotes_page_keyboard(browse_id: int, quotes: list[dict], has_older: bool, has_newer: bool) -> Optional[InlineKeyboardMarkup]:
+    buttons = []
+    if has_newer:
+        buttons.append(InlineKeyboardButton("◀ Newer", callback_data=f"qp:{browse_id}:n:{quotes[0]['id']}"))
+    if has_older:
+        buttons.append(InlineKeyboardButton("Older ▶", callback_data=f"qp:{browse_id}:o:{quotes[-1]['id']}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+def parse_quotes_args(args) -> tuple[str, str, str]:
+    # "/quotes", "/quotes search <terms>", "/quotes by <name>"; bare words are treated as a search
+    if not args:
+        return "", "", "Saved Quotes for this Chat"
+    if args[0].lower() == "by" and len(args) > 1:
+        name = " ".join(args[1:])
+        return "", name, f"Quotes by {name}"
+    if args[0].lower() == "search":
+        args = args[1:]
+        if not args:
+            return "", "", "Saved Quotes for this Chat"
+    terms = " ".join(args)
+    return terms, "", f"Quotes matching {terms}"
+
 async def list_quotes_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    quotes_db = load_quotes()
-    chat_id_str = str(update.message.chat_id)
-    
-    if chat_id_str not in quotes_db or not quotes_db[chat_id_str]:
-        await update.message.reply_text("No quotes saved in this chat yet. Use /quote to save some!", reply_to_message_id=update.message.message_id)
+    chat_id = update.message.chat_id
+    search, by, title = parse_quotes_args(context.args)
+    quotes, has_older, _ = get_quote_store().page(chat_id, search=search, by=by, limit=QUOTES_PAGE_SIZE)
+
+    if not quotes:
+        if search or by:
+            await update.message.reply_text("No saved quotes match that.", reply_to_message_id=update.message.message_id)
+        else:
+            await update.message.reply_text("No quotes saved in this chat yet. Use /quote to save some!", reply_to_message_id=update.message.message_id)
         return
-        
-    chat_quotes = quotes_db[chat_id_str]
-    
-    if len(chat_quotes) > 20:
-        chat_quotes = chat_quotes[-20:]
-        msg = "📜 **Last 20 Saved Quotes for this Chat:**\n\n"
+
+    browse_id = open_quote_browser(chat_id, search, by, title)
+    await update.message.reply_text(
+        format_quotes_page(title, quotes),
+        reply_to_message_id=update.message.message_id, parse_mode='HTML',
+        reply_markup=quotes_page_keyboard(browse_id, quotes, has_older, False),
+    )
+
+async def quotes_page_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    try:
+        _, browse_id, direction, cursor = query.data.split(":")
+        browse_id, cursor = int(browse_id), int(cursor)
+    except ValueError:
+        await query.answer()
+        return
+    browse = quote_browsers.get(browse_id)
+    if browse is None or not query.message or browse[0] != query.message.chat.id:
+        await query.answer("This list expired, run /quotes again.")
+        return
+
+    chat_id, search, by, title = browse
+    quote_browsers.move_to_end(browse_id)
+    if direction == "o":
+        quotes, has_older, has_newer = get_quote_store().page(chat_id, search=search, by=by, before=cursor, limit=QUOTES_PAGE_SIZE)
     else:
-        msg = "📜 **Saved Quotes for this Chat:**\n\n"
-        
-    for i, q in enumerate(chat_quotes, 1):
-        msg += f"_{q['name']}_: \"{q['text']}\"\n"
-        
-    await update.message.reply_text(msg, reply_to_message_id=update.message.message_id, parse_mode='Markdown')
+        quotes, has_older, has_newer = get_quote_store().page(chat_id, search=search, by=by, after=cursor, limit=QUOTES_PAGE_SIZE)
+    if not quotes:
+        await query.answer("No more quotes that way.")
+        return
+    await query.edit_message_text(
+        format_quotes_page(title, quotes), parse_mode='HTML',
+        reply_markup=quotes_page_keyboard(browse_id, quotes, has_older, has_newer),
+    )
+    await query.answer()
 
-def main() -> None:
-    if not BOT_TOKEN:
-        logger.error("BOT_TOKEN is not set in .env file.")
+def is_admin(update: Update) -> bool:
+    return bool(update.effective_user) and update.effective_user.id in ADMIN_USER_IDS
+
+async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update):
+        return
+    message = update.message
+    seconds = PROFILE_SECONDS
+    if context.args:
+        try:
+            seconds = min(max(float(context.args[0]), 1), 600)
+        except ValueError:
+            pass
+    if profiling():
+        await message.reply_text("A profile is already running, wait for it to finish.")
+        return
+    await message.reply_text(f"Profiling worker {os.getpid()} for {seconds:g}s...")
+    report, path = await profile_for(seconds, PROFILE_DIR, render_pool=render_pool)
+    prune_profiles(PROFILE_DIR)
+    await message.reply_document(
+        document=report.encode(), filename=os.path.basename(path)[:-len(".prof")] + ".txt",
+        caption=f"cProfile dump saved as {path}",
+    )
+
+async def stalls_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update):
+        return
+    stalls = list(loop_watchdog.stalls)[-5:]
+    if not stalls:
+        await update.message.reply_text(f"No event loop stalls over {LOOP_STALL_THRESHOLD:g}s in worker {os.getpid()}.")
         return
+    blocks = [
+        f"{s['at']} blocked {s['blocked_ms']}ms\n{s['handler']} -> {s['hot_spot']}\n" + "\n".join(s["stack"][-8:])
+        for s in reversed(stalls)
+    ]
+    text = "\n\n".join(blocks)[:MAX_MESSAGE_CHARS - 20]
+    await update.message.reply_text(f"<pre>{html.escape(text)}</pre>", parse_mode='HTML')
+
+def llm_stats() -> dict:
+    # Per-model calls, errors and latency are exported by llm_gateway as labeled bot_llm_* series
+    report = llm.metrics()
+    stats = {"breaker_closed": int(report["breaker"] == "closed")}
+    for key in ("running", "queued", "rejected", "rejected_background", "coalesced"):
+        stats[key] = report[key]
+    return stats
+
+REGISTRY.add_stats("bot_render_cache", render_cache.stats)
+REGISTRY.add_stats("bot_avatar_cache", avatar_cache.stats)
+REGISTRY.add_stats("bot_theme_cache", theme_classifier.stats)
+REGISTRY.add_stats("bot_render_pool", lambda: {"pending": render_pool.pending, "workers": render_pool.workers})
+REGISTRY.add_stats("bot_chat_state", lambda: get_chat_state().stats())
+REGISTRY.add_stats("bot_file_ids", lambda: get_file_id_store().stats())
+REGISTRY.add_stats("bot_llm", llm_stats)
+REGISTRY.add_stats("bot_chat_memory", chat_memory.stats)
+REGISTRY.add_stats("bot_chat_rate_limit", chat_llm_limit.stats)
+REGISTRY.add_stats("bot_user_rate_limit", user_llm_limit.stats)
+REGISTRY.add_stats("bot_stream_edit_limit", stream_edit_limit.stats)
+REGISTRY.add_stats("bot_loop", loop_watchdog.stats)
+
+def mark_startup(phase: str) -> None:
+    startup_marks.append((phase, time.perf_counter()))
+
+def startup_report() -> dict:
+    report = {}
+    previous = STARTED_AT
+    for phase, at in startup_marks:
+        report[f"{phase}_seconds"] = at - previous
+        previous = at
+    report["total_seconds"] = previous - STARTED_AT
+    return report
+
+REGISTRY.add_stats("bot_startup", startup_report)
+
+_first_update_seen = False
+
+async def note_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    global _first_update_seen
+    if _first_update_seen:
+        return
+    _first_update_seen = True
+    mark_startup("first_update")
+    phases = ", ".join(f"{phase.removesuffix('_seconds')} {seconds:.2f}s" for phase, seconds in startup_report().items())
+    logger.info(f"Time to first update: {phases}")
+
+_metrics_runner = None
 
-    application = Application.builder().token(BOT_TOKEN).build()
+_profile_task = None
 
+async def profile_periodically() -> None:
+    while True:
+        await asyncio.sleep(PROFILE_INTERVAL_MINUTES * 60)
+        try:
+            _, path = await profile_for(PROFILE_SECONDS, PROFILE_DIR, render_pool=render_pool)
+            prune_profiles(PROFILE_DIR)
+            logger.info(f"Periodic profile saved to {path}")
+        except Exception as e:
+            logger.error(f"Periodic profile failed: {e}")
+
+def log_sdk_preload(future: asyncio.Future) -> None:
+    # Nothing awaits the preload; a failure here is retried by the first LLM call, which surfaces its own error
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"LLM SDK preload failed: {future.exception()!r}")
+
+async def start_services(application: Application) -> None:
+    global _metrics_runner, _profile_task
+    get_chat_state().start()
+    if LOOP_STALL_THRESHOLD:
+        loop_watchdog.start()
+    if PROFILE_INTERVAL_MINUTES:
+        _profile_task = asyncio.get_running_loop().create_task(profile_periodically())
+    set_trace_sample_rate(TRACE_SAMPLE_RATE)
+    if METRICS_PORT:
+        _metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    if GEMINI_API_KEY:
+        # Warm the LLM SDK in the background so the first roast doesn't pay for the import
+        preload = asyncio.get_running_loop().run_in_executor(None, llm.load_sdk)
+        preload.add_done_callback(log_sdk_preload)
+    mark_startup("initialized")
+
+async def shutdown_services(application: Application) -> None:
+    if _profile_task is not None:
+        _profile_task.cancel()
+    await loop_watchdog.stop()
+    await get_chat_state().stop()
+    render_pool.shutdown()
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+
+def open_services() -> None:
+    for problem in validate_fonts():
+        logger.error(f"Font check failed: {problem} (run `python image_generator.py` at build time)")
+    warm_fonts()
+    render_pool.start()
+    get_quote_store()
+    get_file_id_store()
+    get_chat_state()
+    mark_startup("services")
+
+def build_application() -> Application:
+    builder = Application.builder().token(BOT_TOKEN).post_init(start_services).post_shutdown(shutdown_services)
+    builder = builder.concurrent_updates(CONCURRENT_UPDATES)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    application = builder.build()
+
+    application.add_handler(TypeHandler(Update, note_first_update), group=-2)
+    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), remember_message), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("quote", quote))
     application.add_handler(CommandHandler("quote_funny", quote_funny))
@@ -407,9 +979,37 @@ def main() -> None:
     application.add_handler(CommandHandler("glaze_on", glaze_on_cmd))
     application.add_handler(CommandHandler("glaze_off", glaze_off_cmd))
     application.add_handler(CommandHandler("quotes", list_quotes_cmd))
+    application.add_handler(CallbackQueryHandler(quotes_page_cb, pattern=r"^qp:"))
+    application.add_handler(CommandHandler("quote_format", quote_format_cmd))
+    application.add_handler(CommandHandler("profile", profile_cmd))
+    application.add_handler(CommandHandler("stalls", stalls_cmd))
     application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_message))
+    return application
+
+def main() -> None:
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN is not set in .env file.")
+        return
+
+    open_services()
+    application = build_application()
 
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if DEPLOY_MODE == "webhook":
+        from webhook import run_webhook
+        if not WEBHOOK_URL:
+            logger.error("WEBHOOK_URL is not set in .env file.")
+            return
+        run_webhook(
+            application,
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
     main()
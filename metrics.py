@@ -0,0 +1,250 @@
+import time
+import random
+import asyncio
+import logging
+import functools
+import contextvars
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, _labels(self.labels, labels), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def set(self, value: float, *labels) -> None:
+        self._values[labels] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", _labels(self.labels, labels, f'le="{_number(bound)}"'), cumulative
+            yield f"{self.name}_sum", _labels(self.labels, labels), total
+            yield f"{self.name}_count", _labels(self.labels, labels), cumulative
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, object] = {}
+        # prefix -> callable returning a flat {name: number} dict, read at scrape time
+        self._stats: dict[str, Callable[[], dict]] = {}
+
+    def register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def add_stats(self, prefix: str, fn: Callable[[], dict]) -> None:
+        self._stats[prefix] = fn
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_number(value)}")
+        for prefix, fn in self._stats.items():
+            try:
+                stats = fn()
+            except Exception as e:
+                logger.error(f"Metrics collector {prefix} failed: {e}")
+                continue
+            for key, value in stats.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str, labels: tuple = ()) -> Counter:
+    return REGISTRY.register(Counter(name, help, labels))
+
+
+def gauge(name: str, help: str, labels: tuple = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, help, labels))
+
+
+def histogram(name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+HANDLER_SECONDS = histogram("bot_handler_seconds", "Time spent in a handler", ("handler",))
+HANDLER_CALLS = counter("bot_handler_calls_total", "Handler invocations by outcome", ("handler", "outcome"))
+HANDLER_IN_FLIGHT = gauge("bot_handler_in_flight", "Handler invocations currently running", ("handler",))
+STAGE_SECONDS = histogram("bot_stage_seconds", "Time spent in one stage of a handler", ("handler", "stage"))
+STAGE_ERRORS = counter("bot_stage_errors_total", "Stages that raised or timed out", ("handler", "stage", "kind"))
+
+
+# -- tracing ---------------------------------------------------------------
+
+_trace_sample_rate = 0.0
+recent_traces: deque = deque(maxlen=50)
+
+
+def set_trace_sample_rate(rate: float) -> None:
+    global _trace_sample_rate
+    _trace_sample_rate = rate
+
+
+class Trace:
+    __slots__ = ("handler", "update_id", "sampled", "start", "spans")
+
+    def __init__(self, handler: str, update_id: Optional[int], sampled: bool):
+        self.handler = handler
+        self.update_id = update_id
+        self.sampled = sampled
+        self.start = time.perf_counter()
+        # (stage, offset from start, duration) in seconds; stages running concurrently overlap
+        self.spans: list[tuple[str, float, float]] = []
+
+    def as_dict(self, total: float) -> dict:
+        return {
+            "handler": self.handler,
+            "update_id": self.update_id,
+            "total_ms": round(total * 1000, 2),
+            "spans": [{"stage": s, "start_ms": round(o * 1000, 2), "ms": round(d * 1000, 2)} for s, o, d in self.spans],
+        }
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("current_trace", default=None)
+
+
+def record_stage(stage: str, seconds: float, start: Optional[float] = None) -> None:
+    trace = _current_trace.get()
+    STAGE_SECONDS.observe(seconds, trace.handler if trace else "none", stage)
+    if trace is not None and trace.sampled:
+        begin = (start if start is not None else time.perf_counter() - seconds) - trace.start
+        trace.spans.append((stage, begin, seconds))
+
+
+@contextmanager
+def stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        trace = _current_trace.get()
+        STAGE_ERRORS.inc(trace.handler if trace else "none", name, "timeout" if isinstance(e, asyncio.TimeoutError) else "error")
+        raise
+    finally:
+        record_stage(name, time.perf_counter() - start, start)
+
+
+def instrument(handler: str):
+    """Times a PTB handler and makes it the current trace for stage() calls inside it."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(update, context, *args, **kwargs):
+            trace = Trace(handler, getattr(update, "update_id", None), random.random() < _trace_sample_rate)
+            token = _current_trace.set(trace)
+            HANDLER_IN_FLIGHT.inc(handler)
+            outcome = "ok"
+            try:
+                return await fn(update, context, *args, **kwargs)
+            except Exception:
+                outcome = "error"
+                raise
+            finally:
+                total = time.perf_counter() - trace.start
+                HANDLER_IN_FLIGHT.dec(handler)
+                HANDLER_CALLS.inc(handler, outcome)
+                HANDLER_SECONDS.observe(total, handler)
+                _current_trace.reset(token)
+                if trace.sampled:
+                    recent_traces.append(trace.as_dict(total))
+                    spans = " ".join(f"{s}={d * 1000:.0f}ms@{o * 1000:.0f}" for s, o, d in trace.spans)
+                    logger.info(f"trace {handler} update={trace.update_id} total={total * 1000:.0f}ms {spans}")
+        return wrapper
+    return decorator
+
+
+async def start_metrics_server(host: str, port: int):
+    from aiohttp import web
+
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(body=REGISTRY.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def traces(request: web.Request) -> web.Response:
+        return web.json_response(list(recent_traces))
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    app.router.add_get("/traces", traces)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics on http://{host}:{port}/metrics")
+    return runner
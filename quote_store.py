@@ -0,0 +1,168 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS quotes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    text TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS quotes_chat_hash ON quotes (chat_id, hash);
+CREATE INDEX IF NOT EXISTS quotes_chat_id ON quotes (chat_id, id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# External-content index over quotes, kept in step by triggers so every add() updates it in the same write.
+# chat_id is indexed too so a search only walks that chat's postings.
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS quotes_fts USING fts5(
+    chat_id, name, text, content='quotes', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS quotes_fts_insert AFTER INSERT ON quotes BEGIN
+    INSERT INTO quotes_fts (rowid, chat_id, name, text) VALUES (new.id, new.chat_id, new.name, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS quotes_fts_delete AFTER DELETE ON quotes BEGIN
+    INSERT INTO quotes_fts (quotes_fts, rowid, chat_id, name, text) VALUES ('delete', old.id, old.chat_id, old.name, old.text);
+END;
+"""
+
+
+def fts_query(text: str, column: str) -> str:
+    # Every word becomes a quoted whole-token term, so user input can't inject FTS5 syntax.
+    # No prefix (*) terms: those merge every matching doclist and get slow on common words.
+    return " AND ".join(f'{column} : "{token}"' for token in re.findall(r"\w+", text))
+
+
+def quote_hash(name: str, text: str) -> str:
+    return hashlib.sha1(f"{name}\0{text}".encode("utf-8")).hexdigest()
+
+
+class QuoteStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self.has_fts = self._init_fts()
+
+    def _init_fts(self) -> bool:
+        existed = self._conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'quotes_fts'").fetchone()
+        try:
+            self._conn.executescript(FTS_SCHEMA)
+        except sqlite3.OperationalError as e:
+            logger.warning(f"SQLite has no FTS5 ({e}); quote search falls back to LIKE scans")
+            return False
+        if not existed:
+            # First start on an older database: index the quotes saved so far
+            self._conn.execute("INSERT INTO quotes_fts (quotes_fts) VALUES ('rebuild')")
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def add(self, chat_id, name: str, text: str) -> bool:
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO quotes (chat_id, name, text, hash, created_at) VALUES (?, ?, ?, ?, ?)",
+                (str(chat_id), name, text, quote_hash(name, text), time.time()),
+            )
+        return cur.rowcount > 0
+
+    def page(self, chat_id, search: str = "", by: str = "", before: Optional[int] = None, after: Optional[int] = None,
+             limit: int = 10) -> tuple[list[dict], bool, bool]:
+        """One page of a chat's quotes, newest first, plus whether older and newer pages exist.
+
+        Pages are keyed by quote id (before/after) rather than OFFSET, so deep pages cost the same as the first.
+        """
+        chat_id = str(chat_id)
+        use_fts = bool(search or by) and self.has_fts
+        # Bounding the FTS rowid (not q.id) lets SQLite seek inside the postings for deep pages
+        id_col = "quotes_fts.rowid" if use_fts else "q.id"
+        where, params = ["q.chat_id = ?"], [chat_id]
+        if before is not None:
+            where.append(f"{id_col} < ?")
+            params.append(before)
+        if after is not None:
+            where.append(f"{id_col} > ?")
+            params.append(after)
+
+        if use_fts:
+            terms = [fts_query(chat_id, "chat_id"), fts_query(search, "text"), fts_query(by, "name")]
+            match = " AND ".join(t for t in terms if t)
+            source = "quotes_fts JOIN quotes q ON q.id = quotes_fts.rowid"
+            where.insert(0, "quotes_fts MATCH ?")
+            params.insert(0, match)
+        else:
+            source = "quotes q"
+            for column, value in (("text", search), ("name", by)):
+                for token in re.findall(r"\w+", value):
+                    where.append(f"q.{column} LIKE ?")
+                    params.append(f"%{token}%")
+
+        order = "ASC" if after is not None and before is None else "DESC"
+        sql = f"SELECT q.id, q.name, q.text FROM {source} WHERE {' AND '.join(where)} ORDER BY {id_col} {order} LIMIT ?"
+        with self._lock:
+            rows = self._conn.execute(sql, (*params, limit + 1)).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if order == "ASC":
+            rows.reverse()
+            has_older, has_newer = True, more
+        else:
+            has_older, has_newer = more, before is not None
+        return [{"id": i, "name": name, "text": text} for i, name, text in rows], has_older, has_newer
+
+    def migrate_json(self, json_path: str) -> int:
+        # One-shot import of the old quotes_data.json; the file is renamed afterwards so it never runs twice
+        if not os.path.exists(json_path):
+            return 0
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+                return 0
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                quotes_db = json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to read {json_path} for migration: {e}")
+            return 0
+
+        now = time.time()
+        rows = [
+            (chat_id, q["name"], q["text"], quote_hash(q["name"], q["text"]), now)
+            for chat_id, chat_quotes in quotes_db.items()
+            for q in chat_quotes
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                # rowcount sums rows actually inserted; total_changes would also count the FTS trigger writes
+                imported = self._conn.executemany(
+                    "INSERT OR IGNORE INTO quotes (chat_id, name, text, hash, created_at) VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                ).rowcount
+                self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)", (json_path,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        os.replace(json_path, json_path + ".migrated")
+        logger.info(f"Migrated {imported} quotes from {json_path}")
+        return imported
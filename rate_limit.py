@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated", "warned")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+        self.warned = False
+
+
+class RateLimiter:
+    # `rate` requests per `per` seconds per key, with bursts of up to `burst`
+    def __init__(self, rate: float, burst: int, per: float = 60.0, max_keys: int = 10000):
+        self.rate = rate / per
+        self.burst = burst
+        self.max_keys = max_keys
+        # A bucket idle this long is full again, so forgetting it changes nothing
+        self.idle_after = burst / self.rate if self.rate > 0 else float("inf")
+        # Least recently used key first, so pruning only ever looks at the front
+        self._buckets: OrderedDict[object, TokenBucket] = OrderedDict()
+        self.allowed = 0
+        self.limited = 0
+
+    def stats(self) -> dict:
+        return {"keys": len(self._buckets), "allowed": self.allowed, "limited": self.limited}
+
+    def _bucket(self, key, now: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._prune(now)
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        return bucket
+
+    def _prune(self, now: float) -> None:
+        while self._buckets:
+            bucket = next(iter(self._buckets.values()))
+            if len(self._buckets) < self.max_keys and now - bucket.updated < self.idle_after:
+                break
+            self._buckets.popitem(last=False)
+
+    def wait_time(self, key) -> float:
+        """Seconds until `key` has a token again; 0 if it has one now, inf if the rate is 0. Takes nothing."""
+        if self.rate <= 0:
+            return float("inf")
+        bucket = self._bucket(key, time.monotonic())
+        if bucket.tokens >= 1:
+            return 0.0
+        return (1 - bucket.tokens) / self.rate
+
+    def take(self, key) -> None:
+        bucket = self._bucket(key, time.monotonic())
+        bucket.tokens -= 1
+        bucket.warned = False
+        self.allowed += 1
+
+    def refuse(self, key) -> bool:
+        # True only for the first refusal since the last allowed request, so the caller warns once per run of spam
+        self.limited += 1
+        bucket = self._bucket(key, time.monotonic())
+        if bucket.warned:
+            return False
+        bucket.warned = True
+        return True
@@ -0,0 +1,227 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+from image_encoder import DEFAULT_FORMAT
+
+logger = logging.getLogger(__name__)
+
+
+def make_render_key(avatar_bytes: Optional[bytes], name: str, text: str, theme: str, time_text: str, output_format: str = DEFAULT_FORMAT) -> str:
+    avatar_hash = hashlib.sha1(avatar_bytes).hexdigest() if avatar_bytes else "-"
+    parts = [avatar_hash, name, text, theme, time_text]
+    # PNG keys stay as they were before output formats existed, so stored file_ids keep matching
+    if output_format != DEFAULT_FORMAT:
+        parts.append(output_format)
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def make_multi_render_key(messages: list[dict], theme: str, output_format: str = DEFAULT_FORMAT) -> str:
+    parts = [make_render_key(m.get("avatar"), m["name"], m["text"], theme, m.get("time_text") or "", output_format) for m in messages]
+    # Sender ids decide bubble grouping, so two runs with the same texts can still render differently
+    parts += [str(m.get("sender", "")) for m in messages]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, spill_dir: Optional[str] = None, spill_max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self._items: OrderedDict[str, bytes] = OrderedDict()
+        self._size = 0
+        self._spilled: OrderedDict[str, int] = OrderedDict()
+        self._spilled_size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            entries = []
+            for fname in os.listdir(spill_dir):
+                if fname.endswith(".img"):
+                    st = os.stat(os.path.join(spill_dir, fname))
+                    entries.append((st.st_mtime, fname[:-4], st.st_size))
+            for _, key, size in sorted(entries):
+                self._spilled[key] = size
+                self._spilled_size += size
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._items),
+            "bytes": self._size,
+            "spilled_entries": len(self._spilled),
+            "spilled_bytes": self._spilled_size,
+        }
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return data
+        data = self._read_spill(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self.put(key, data)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        evicted = []
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                old_key, old_data = self._items.popitem(last=False)
+                self._size -= len(old_data)
+                self.evictions += 1
+                evicted.append((old_key, old_data))
+        for old_key, old_data in evicted:
+            self._write_spill(old_key, old_data)
+
+    def _spill_path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, key + ".img")
+
+    def _read_spill(self, key: str) -> Optional[bytes]:
+        if not self.spill_dir or key not in self._spilled:
+            return None
+        try:
+            with open(self._spill_path(key), "rb") as f:
+                return f.read()
+        except OSError:
+            with self._lock:
+                size = self._spilled.pop(key, None)
+                if size is not None:
+                    self._spilled_size -= size
+            return None
+
+    def _write_spill(self, key: str, data: bytes) -> None:
+        if not self.spill_dir or len(data) > self.spill_max_bytes:
+            return
+        try:
+            with open(self._spill_path(key), "wb") as f:
+                f.write(data)
+        except OSError as e:
+            logger.error(f"Failed to spill render {key}: {e}")
+            return
+        with self._lock:
+            size = self._spilled.pop(key, None)
+            if size is not None:
+                self._spilled_size -= size
+            self._spilled[key] = len(data)
+            self._spilled_size += len(data)
+            dropped = []
+            while self._spilled_size > self.spill_max_bytes:
+                old_key, old_size = self._spilled.popitem(last=False)
+                self._spilled_size -= old_size
+                dropped.append(old_key)
+        for old_key in dropped:
+            try:
+                os.remove(self._spill_path(old_key))
+            except OSError:
+                pass
+
+
+class FileIdStore:
+    """Maps render keys to Telegram file_ids so repeat quotes are re-sent by reference.
+
+    SQLite holds every file_id; memory keeps only the `max_entries` most recently used ones, and a miss falls
+    back to the database. Rows older than `max_age` are pruned at most once per `prune_interval`.
+    """
+
+    def __init__(self, path: str, max_age: float = 30 * 24 * 3600, max_entries: int = 10000, prune_interval: float = 3600.0):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.prune_interval = prune_interval
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS file_ids (key TEXT PRIMARY KEY, file_id TEXT NOT NULL, created_at REAL NOT NULL)")
+        # key -> (file_id, created_at), least recently used first
+        self._file_ids: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._next_prune = 0.0
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.pruned = 0
+        self.prune()
+        # Warm up with the newest uploads; oldest first so they are the first to go
+        rows = self._conn.execute(
+            "SELECT key, file_id, created_at FROM file_ids ORDER BY created_at DESC LIMIT ?", (max_entries,)
+        ).fetchall()
+        for key, file_id, created_at in reversed(rows):
+            self._file_ids[key] = (file_id, created_at)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._file_ids), "hits": self.hits, "db_hits": self.db_hits, "misses": self.misses, "pruned": self.pruned}
+
+    def _remember(self, key: str, file_id: str, created_at: float) -> None:
+        # Caller holds the lock
+        self._file_ids[key] = (file_id, created_at)
+        self._file_ids.move_to_end(key)
+        while len(self._file_ids) > self.max_entries:
+            self._file_ids.popitem(last=False)
+
+    def prune(self) -> int:
+        cutoff = time.time() - self.max_age
+        with self._lock:
+            self._next_prune = time.monotonic() + self.prune_interval
+            deleted = self._conn.execute("DELETE FROM file_ids WHERE created_at < ?", (cutoff,)).rowcount
+            for key in [k for k, (_, created_at) in self._file_ids.items() if created_at < cutoff]:
+                del self._file_ids[key]
+        self.pruned += deleted
+        return deleted
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._file_ids.get(key)
+            if entry is not None:
+                self._file_ids.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            # Evicted from memory, or uploaded by another process sharing the database since we loaded
+            row = self._conn.execute("SELECT file_id, created_at FROM file_ids WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.db_hits += 1
+            self._remember(key, row[0], row[1])
+            return row[0]
+
+    def put(self, key: str, file_id: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._remember(key, file_id, now)
+            self._conn.execute("INSERT OR REPLACE INTO file_ids (key, file_id, created_at) VALUES (?, ?, ?)", (key, file_id, now))
+        if time.monotonic() >= self._next_prune:
+            self.prune()
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self._file_ids.pop(key, None)
+            self._conn.execute("DELETE FROM file_ids WHERE key = ?", (key,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,110 @@
+import os
+import time
+import cProfile
+import asyncio
+import logging
+from io import BytesIO
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+from image_generator import render_multi_quote, warm_fonts
+from image_encoder import encode_image, DEFAULT_FORMAT
+from metrics import counter, histogram, record_stage
+
+logger = logging.getLogger(__name__)
+
+ENCODE_SECONDS = histogram(
+    "bot_encode_seconds", "Time to encode a rendered quote, by output format", labels=("format",),
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+ENCODED_BYTES = counter("bot_encoded_bytes_total", "Bytes of encoded quote images, by output format", labels=("format",))
+
+
+class RenderBusyError(Exception):
+    pass
+
+
+def _render_and_encode(messages: list[dict], theme: str, output_format: str) -> tuple[bytes, float]:
+    # Runs inside the worker; plain bytes pickle cheaper than a BytesIO
+    img = render_multi_quote(messages, theme)
+    start = time.perf_counter()
+    data = encode_image(img, output_format)
+    return data, time.perf_counter() - start
+
+
+def _profiled(fn, *args):
+    # Runs inside the worker while a profile is being taken; the raw pstats dict pickles back with the result
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        result = fn(*args)
+    finally:
+        profiler.disable()
+    profiler.create_stats()
+    return result, profiler.stats
+
+
+class RenderPool:
+    def __init__(self, workers: int = 0, kind: str = "process", max_pending: int = 0, queue_timeout: float = 10.0):
+        self.workers = workers or os.cpu_count() or 1
+        self.kind = kind
+        self.max_pending = max_pending or self.workers * 4
+        self.queue_timeout = queue_timeout
+        self._executor: Optional[Executor] = None
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self.pending = 0
+        # Worker-side profiles of each render while profiling is on, None otherwise
+        self._profiles: Optional[list[dict]] = None
+
+    def start(self) -> None:
+        if self._executor is not None:
+            return
+        if self.kind == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="render", initializer=warm_fonts)
+        else:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_fonts)
+        logger.info(f"Render pool started: {self.workers} {self.kind} workers, {self.max_pending} pending max")
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, fn, *args):
+        if self._executor is None:
+            self.start()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise RenderBusyError(f"render queue full ({self.max_pending} pending)")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            if self._profiles is None:
+                return await loop.run_in_executor(self._executor, fn, *args)
+            result, stats = await loop.run_in_executor(self._executor, _profiled, fn, *args)
+            if self._profiles is not None:
+                self._profiles.append(stats)
+            return result
+        finally:
+            self.pending -= 1
+            self._slots.release()
+
+    def start_profiling(self) -> None:
+        self._profiles = []
+
+    def stop_profiling(self) -> list[dict]:
+        """Stops profiling and returns one pstats dict per render that finished meanwhile."""
+        profiles, self._profiles = self._profiles or [], None
+        return profiles
+
+    async def render_multi_quote(self, messages: list[dict], theme: str = "default", output_format: str = DEFAULT_FORMAT) -> BytesIO:
+        data, encode_time = await self.run(_render_and_encode, messages, theme, output_format)
+        record_stage("encode", encode_time)
+        ENCODE_SECONDS.observe(encode_time, output_format)
+        ENCODED_BYTES.inc(output_format, amount=len(data))
+        return BytesIO(data)
+
+    async def render_quote(self, avatar_bytes: Optional[bytes], name: str, text: str, theme: str = "default", time_text: Optional[str] = None,
+                           output_format: str = DEFAULT_FORMAT) -> BytesIO:
+        message = {"avatar": avatar_bytes, "name": name, "text": text, "time_text": time_text}
+        return await self.render_multi_quote([message], theme, output_format)
@@ -0,0 +1,301 @@
+import os
+import zlib
+import signal
+import asyncio
+import logging
+import multiprocessing as mp
+from collections import deque
+from datetime import timedelta
+from queue import Empty
+from typing import Optional
+from aiohttp import web
+from telegram import Bot, Update
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import Application
+import main
+from metrics import REGISTRY, counter, start_metrics_server
+from webhook import build_web_app
+
+logger = logging.getLogger(__name__)
+
+SHARD_ROUTED = counter("bot_shard_routed_total", "Updates routed to each shard worker", ("shard",))
+
+
+def update_chat_id(data: dict) -> Optional[int]:
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if key in data:
+            return data[key]["chat"]["id"]
+    callback = data.get("callback_query")
+    if callback:
+        if callback.get("message"):
+            return callback["message"]["chat"]["id"]
+        return callback["from"]["id"]
+    return None
+
+
+def shard_for(chat_id: Optional[int], shards: int) -> int:
+    # crc32 rather than hash(): it has to agree across processes and restarts
+    if chat_id is None:
+        return 0
+    return zlib.crc32(str(chat_id).encode()) % shards
+
+
+class ChatDispatcher:
+    """Runs updates concurrently across chats but strictly in arrival order within a chat."""
+
+    def __init__(self, application: Application, max_concurrent: int):
+        self.application = application
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._chats: dict[int, deque] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.processed = 0
+
+    def submit(self, chat_id: Optional[int], update: Update) -> None:
+        if chat_id is None:
+            self._spawn(self._process(update))
+            return
+        queue = self._chats.get(chat_id)
+        if queue is not None:
+            queue.append(update)
+            return
+        self._chats[chat_id] = deque([update])
+        self._spawn(self._drain(chat_id))
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, update: Update) -> None:
+        # A slot is only taken once the update is next in line, so one busy chat can't starve the rest
+        async with self._slots:
+            try:
+                await self.application.process_update(update)
+            except Exception as e:
+                logger.error(f"Update {update.update_id} failed: {e}")
+        self.processed += 1
+
+    async def _drain(self, chat_id: int) -> None:
+        queue = self._chats[chat_id]
+        try:
+            while queue:
+                await self._process(queue.popleft())
+        finally:
+            del self._chats[chat_id]
+
+    async def join(self) -> None:
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+async def run_worker(index: int, queue) -> None:
+    if main.METRICS_PORT:
+        # The supervisor keeps METRICS_PORT; shard N serves on METRICS_PORT + N + 1
+        main.METRICS_PORT += index + 1
+    main.open_services()
+    application = main.build_application()
+    dispatcher = ChatDispatcher(application, main.CONCURRENT_UPDATES)
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    parent = os.getppid()
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        logger.info(f"Shard worker {index} ready (pid {os.getpid()})")
+        while not stop.is_set():
+            try:
+                data = await loop.run_in_executor(None, queue.get, True, 1.0)
+            except Empty:
+                # A supervisor that was killed or crashed never sends the sentinel
+                if os.getppid() != parent:
+                    logger.error(f"Shard worker {index} lost its supervisor; stopping")
+                    break
+                continue
+            if data is None:
+                break
+            dispatcher.submit(update_chat_id(data), Update.de_json(data, application.bot))
+        await dispatcher.join()
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+    logger.info(f"Shard worker {index} stopped after {dispatcher.processed} updates")
+
+
+def worker_main(index: int, queue) -> None:
+    # The supervisor owns shutdown: it sends a None sentinel once intake has stopped, so Ctrl-C on the process
+    # group is left to it. SIGTERM and the supervisor going away stop the worker cleanly too.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_worker(index, queue))
+
+
+def make_bot() -> Bot:
+    if main.TELEGRAM_API_URL:
+        return Bot(main.BOT_TOKEN, base_url=f"{main.TELEGRAM_API_URL}/bot", base_file_url=f"{main.TELEGRAM_API_URL}/file/bot")
+    return Bot(main.BOT_TOKEN)
+
+
+class Supervisor:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._ctx = mp.get_context("spawn")
+        self.queues = [self._ctx.Queue() for _ in range(workers)]
+        self.procs: list = [None] * workers
+        self.routed = [0] * workers
+        self.restarts = 0
+        self.intake_restarts = 0
+        self.offset: Optional[int] = None
+
+    def start_worker(self, index: int) -> None:
+        proc = self._ctx.Process(target=worker_main, args=(index, self.queues[index]), name=f"shard-{index}")
+        proc.start()
+        self.procs[index] = proc
+
+    def route(self, data: dict) -> None:
+        shard = shard_for(update_chat_id(data), self.workers)
+        self.queues[shard].put(data)
+        self.routed[shard] += 1
+        SHARD_ROUTED.inc(str(shard))
+
+    async def poll(self, bot: Bot) -> None:
+        backoff = 1.0
+        while True:
+            try:
+                updates = await bot.get_updates(offset=self.offset, timeout=30, allowed_updates=main.ALLOWED_UPDATES)
+            except RetryAfter as e:
+                retry = e.retry_after
+                retry = retry.total_seconds() if isinstance(retry, timedelta) else retry
+                logger.warning(f"getUpdates flood-limited; retrying in {retry}s")
+                await asyncio.sleep(retry)
+                continue
+            except TelegramError as e:
+                # Includes Conflict while another instance still polls during a rolling restart
+                logger.error(f"getUpdates failed: {e}; retrying in {backoff:g}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+            backoff = 1.0
+            for update in updates:
+                self.offset = update.update_id + 1
+                self.route(update.to_dict())
+
+    async def monitor(self) -> None:
+        # A crashed shard is restarted on the same queue, so its chats keep their ordering
+        while True:
+            await asyncio.sleep(1)
+            for index, proc in enumerate(self.procs):
+                if not proc.is_alive():
+                    logger.error(f"Shard worker {index} exited with code {proc.exitcode}; restarting")
+                    self.restarts += 1
+                    self.start_worker(index)
+
+    def status(self) -> dict:
+        return {
+            "workers": [proc.is_alive() for proc in self.procs],
+            "routed": self.routed,
+            "restarts": self.restarts,
+        }
+
+    def stop_workers(self, timeout: float = 30) -> None:
+        for queue in self.queues:
+            queue.put(None)
+        for index, proc in enumerate(self.procs):
+            proc.join(timeout)
+            if proc.is_alive():
+                logger.error(f"Shard worker {index} did not stop in {timeout}s; terminating")
+                proc.terminate()
+
+    async def run(self) -> None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+
+        for index in range(self.workers):
+            self.start_worker(index)
+        monitor = loop.create_task(self.monitor())
+        REGISTRY.add_stats("bot_supervisor", lambda: {
+            "workers_alive": sum(self.status()["workers"]), "restarts": self.restarts, "intake_restarts": self.intake_restarts,
+        })
+        metrics_runner = await start_metrics_server(main.METRICS_HOST, main.METRICS_PORT) if main.METRICS_PORT else None
+        runner = None
+        intake = None
+
+        async def handle_update(data: dict) -> None:
+            self.route(data)
+
+        def start_intake(bot: Bot) -> None:
+            nonlocal intake
+            if stop.is_set():
+                return
+            intake = loop.create_task(self.poll(bot))
+            intake.add_done_callback(lambda task: intake_done(bot, task))
+
+        def intake_done(bot: Bot, task: asyncio.Task) -> None:
+            # poll() only returns by raising; without this the workers would idle on with nothing feeding them
+            if task.cancelled() or stop.is_set():
+                return
+            logger.error(f"Update intake crashed: {task.exception()!r}; restarting in 1s")
+            self.intake_restarts += 1
+            loop.call_later(1, start_intake, bot)
+
+        try:
+            async with make_bot() as bot:
+                if main.DEPLOY_MODE == "webhook":
+                    runner = web.AppRunner(build_web_app(handle_update, main.WEBHOOK_PATH, main.WEBHOOK_SECRET, status=self.status))
+                    await runner.setup()
+                    await web.TCPSite(runner, main.WEBHOOK_LISTEN, main.WEBHOOK_PORT).start()
+                    await bot.set_webhook(
+                        url=main.WEBHOOK_URL,
+                        allowed_updates=main.ALLOWED_UPDATES,
+                        secret_token=main.WEBHOOK_SECRET or None,
+                    )
+                else:
+                    await bot.delete_webhook()
+                    start_intake(bot)
+                logger.info(f"Supervisor routing {main.DEPLOY_MODE} updates to {self.workers} shard workers")
+                await stop.wait()
+                if intake is not None:
+                    intake.cancel()
+                    await asyncio.gather(intake, return_exceptions=True)
+                    if self.offset is not None:
+                        # Confirm what was routed so Telegram doesn't redeliver it after a restart
+                        try:
+                            await bot.get_updates(offset=self.offset, timeout=0)
+                        except TelegramError as e:
+                            logger.error(f"Could not confirm updates up to {self.offset}: {e}")
+        finally:
+            for task in (intake, monitor):
+                if task is not None:
+                    task.cancel()
+            for web_runner in (runner, metrics_runner):
+                if web_runner is not None:
+                    await web_runner.cleanup()
+            await asyncio.to_thread(self.stop_workers)
+
+
+def run_supervisor() -> None:
+    if not main.BOT_TOKEN:
+        logger.error("BOT_TOKEN is not set in .env file.")
+        return
+    if main.DEPLOY_MODE == "webhook" and not main.WEBHOOK_URL:
+        logger.error("WEBHOOK_URL is not set in .env file.")
+        return
+
+    workers = main.SHARD_WORKERS or os.cpu_count() or 1
+    # Split the cores between shards unless the render pool size was set explicitly. Shards re-import main and
+    # load_dotenv leaves variables already in the environment alone, so .env's RENDER_WORKERS=0 must be overwritten.
+    if not main.RENDER_WORKERS:
+        os.environ["RENDER_WORKERS"] = str(max(1, (os.cpu_count() or 1) // workers))
+    # Run the one-shot JSON migration here so shards don't race on it
+    main.get_quote_store()
+    asyncio.run(Supervisor(workers).run())
+
+
+if __name__ == "__main__":
+    run_supervisor()
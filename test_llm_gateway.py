@@ -0,0 +1,86 @@
+import asyncio
+from llm_gateway import FairScheduler, LLMBusyError
+
+
+def test_release_skips_waiter_that_timed_out():
+    async def run():
+        scheduler = FairScheduler(max_concurrency=1, per_chat=1, max_pending=10, timeout=5)
+        await scheduler.acquire(1)
+        waiter = asyncio.ensure_future(scheduler.acquire(2))
+        await asyncio.sleep(0)
+        # The window after wait_for cancels the future but before the waiter's cleanup has run
+        scheduler._waiting[2][0].cancel()
+        scheduler.release(1)
+        try:
+            await waiter
+        except (asyncio.CancelledError, LLMBusyError):
+            pass
+        assert scheduler.running == 0
+        assert scheduler.pending == 0
+        assert not scheduler._waiting
+        await asyncio.wait_for(scheduler.acquire(3), timeout=1)
+        assert scheduler.running == 1
+
+    asyncio.run(run())
+
+
+def test_timeout_raises_busy_and_frees_nothing():
+    async def run():
+        scheduler = FairScheduler(max_concurrency=1, per_chat=1, max_pending=10, timeout=0.05)
+        await scheduler.acquire(1)
+        try:
+            await scheduler.acquire(2)
+        except LLMBusyError:
+            pass
+        else:
+            raise AssertionError("expected LLMBusyError")
+        scheduler.release(1)
+        assert scheduler.running == 0
+        assert scheduler.pending == 0
+        assert scheduler.rejected == 1
+
+    asyncio.run(run())
+
+
+def test_release_hands_slot_to_next_chat():
+    async def run():
+        scheduler = FairScheduler(max_concurrency=1, per_chat=1, max_pending=10, timeout=5)
+        await scheduler.acquire(1)
+        waiters = [asyncio.ensure_future(scheduler.acquire(chat)) for chat in (2, 3)]
+        await asyncio.sleep(0)
+        waiters[0].cancel()
+        await asyncio.sleep(0)
+        scheduler.release(1)
+        await asyncio.wait_for(waiters[1], timeout=1)
+        assert scheduler.running == 1
+        assert scheduler.pending == 0
+
+    asyncio.run(run())
+
+
+def test_background_only_takes_spare_slots():
+    async def run():
+        scheduler = FairScheduler(max_concurrency=4, per_chat=2, max_pending=10, timeout=5)
+        await scheduler.acquire(1, background=True)
+        await scheduler.acquire(2)
+        # Half the slots are busy now, so background work is turned away without queueing
+        try:
+            await scheduler.acquire(3, background=True)
+        except LLMBusyError:
+            pass
+        else:
+            raise AssertionError("expected LLMBusyError")
+        assert scheduler.pending == 0
+        assert scheduler.rejected_background == 1
+        await scheduler.acquire(3)
+        assert scheduler.running == 3
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    test_release_skips_waiter_that_timed_out()
+    test_timeout_raises_busy_and_frees_nothing()
+    test_release_hands_slot_to_next_chat()
+    test_background_only_takes_spare_slots()
+    print("Success")
@@ -0,0 +1,75 @@
+from functools import lru_cache
+from PIL import ImageFont
+
+# Fonts come from the process-wide registry in image_generator, so a font object
+# is a stable cache key for as long as the process lives.
+
+
+@lru_cache(maxsize=65536)
+def word_width(font: ImageFont.FreeTypeFont, word: str) -> float:
+    return font.getlength(word)
+
+
+@lru_cache(maxsize=4096)
+def _prefix_widths(font: ImageFont.FreeTypeFont, word: str) -> tuple[float, ...]:
+    # Running sum of glyph advances; index k is the width of word[:k + 1]
+    widths = []
+    total = 0.0
+    for ch in word:
+        total += word_width(font, ch)
+        widths.append(total)
+    return tuple(widths)
+
+
+def _fit_prefix(font: ImageFont.FreeTypeFont, word: str, max_width: int) -> int:
+    # Binary search for the longest prefix that fits; always at least one character
+    widths = _prefix_widths(font, word)
+    lo, hi = 1, len(word)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if widths[mid - 1] <= max_width:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def break_word(font: ImageFont.FreeTypeFont, word: str, max_width: int) -> list[tuple[str, float]]:
+    pieces = []
+    while word:
+        if word_width(font, word) <= max_width:
+            pieces.append((word, word_width(font, word)))
+            break
+        k = _fit_prefix(font, word, max_width)
+        piece = word[:k]
+        pieces.append((piece, word_width(font, piece)))
+        word = word[k:]
+    return pieces
+
+
+def wrap_text(text: str, font: ImageFont.FreeTypeFont, max_width: int) -> list[tuple[str, float]]:
+    """Greedy word wrap returning (line, width) pairs; empty lines are paragraph breaks."""
+    space = word_width(font, " ")
+    lines = []
+    for p in text.split('\n'):
+        if not p.strip():
+            lines.append(("", 0.0))
+            continue
+        current, current_width = None, 0.0
+        for word in p.split(' '):
+            w = word_width(font, word)
+            if current is not None and current_width + space + w <= max_width:
+                current += " " + word
+                current_width += space + w
+                continue
+            if current is not None:
+                lines.append((current, current_width))
+            if w > max_width:
+                # Hard-break words that can't fit on a line of their own; the tail keeps accepting words
+                pieces = break_word(font, word, max_width)
+                lines.extend(pieces[:-1])
+                current, current_width = pieces[-1]
+            else:
+                current, current_width = word, w
+        lines.append((current, current_width))
+    return lines
@@ -0,0 +1,116 @@
+import re
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+from image_generator import THEMES
+
+THEME_NAMES = list(THEMES)
+
+THEME_KEYWORDS = {
+    "sigma": {"sigma", "alpha", "grindset", "lone", "wolf", "mewing", "aura", "gigachad", "chad", "based"},
+    "hacker": {"hack", "hacker", "hacking", "code", "coding", "python", "linux", "terminal", "bug", "server", "sudo", "password", "malware", "cyber"},
+    "romantic": {"love", "loves", "crush", "kiss", "heart", "babe", "baby", "darling", "date", "marry", "miss", "cute", "❤", "❤️", "😍", "🥰", "😘"},
+    "hustle": {"money", "grind", "hustle", "work", "rich", "cash", "business", "invest", "profit", "boss", "millionaire", "💰", "💸"},
+    "spooky": {"ghost", "scary", "dead", "death", "haunted", "demon", "blood", "horror", "creepy", "spooky", "halloween", "👻", "💀", "🎃"},
+    "sad": {"sad", "cry", "crying", "alone", "lonely", "depressed", "tears", "hurt", "miss", "broken", "pain", "😢", "😭", "💔"},
+}
+
+_WORD_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def parse_theme(result: str) -> str:
+    for t in THEME_NAMES:
+        if t in result:
+            return t
+    return "default"
+
+
+def guess_theme(text: str) -> Optional[str]:
+    # Cheap local pass; returns None when it isn't confident enough to skip the LLM
+    normalized = normalize_text(text)
+    tokens = _WORD_RE.findall(normalized)
+    if not any(tok.isalpha() for tok in tokens) or len(normalized) < 4:
+        return "default"
+
+    scores = {t: 0 for t in THEME_NAMES}
+    for tok in tokens:
+        for t, words in THEME_KEYWORDS.items():
+            if tok in words:
+                scores[t] += 1
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    (best, best_score), (_, runner_up) = ranked[0], ranked[1]
+    if best_score >= 2 and runner_up == 0:
+        return best
+    return None
+
+
+class ThemeClassifier:
+    def __init__(self, llm: Callable[[str], Awaitable[str]], max_entries: int = 4096):
+        self.llm = llm
+        self.max_entries = max_entries
+        self._cache: OrderedDict[str, str] = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.heuristic_hits = 0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "heuristic_hits": self.heuristic_hits,
+            "entries": len(self._cache),
+        }
+
+    def _remember(self, key: str, theme: str) -> None:
+        self._cache[key] = theme
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    async def classify(self, text: str) -> str:
+        key = text_key(text)
+        theme = self._cache.get(key)
+        if theme is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return theme
+
+        theme = guess_theme(text)
+        if theme is not None:
+            self.heuristic_hits += 1
+            self._remember(key, theme)
+            return theme
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.hits += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            prompt = f"Analyze this text and strictly classify it into EXACTLY ONE of these categories: sigma, hacker, romantic, hustle, spooky, sad, default. Output just the category word in lowercase. Text: '{text}'"
+            result = await self.llm(prompt)
+            theme = parse_theme(result)
+            # An empty result means the model call failed; answer "default" now but ask again next time
+            if result:
+                self._remember(key, theme)
+            future.set_result(theme)
+            return theme
+        except BaseException as e:
+            future.set_exception(e if isinstance(e, Exception) else RuntimeError("theme classification cancelled"))
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
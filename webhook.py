@@ -0,0 +1,75 @@
+import asyncio
+import signal
+import logging
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def build_web_app(handle_update, path: str, secret_token: str = "", status=None) -> web.Application:
+    async def receive_update(request: web.Request) -> web.Response:
+        if secret_token and request.headers.get(SECRET_HEADER) != secret_token:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except Exception:
+            return web.Response(status=400)
+        # Ack straight away; updates are processed off the request path
+        await handle_update(data)
+        return web.Response()
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({"ok": True, **(status() if status else {})})
+
+    app = web.Application()
+    app.router.add_post(path, receive_update)
+    app.router.add_get("/healthz", health)
+    return app
+
+
+async def serve_webhook(application: Application, listen: str, port: int, path: str, webhook_url: str,
+                        secret_token: str = "", allowed_updates=None, max_connections: int = 40) -> None:
+    async def enqueue(data: dict) -> None:
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    web_app = build_web_app(enqueue, path, secret_token, status=lambda: {"queued_updates": application.update_queue.qsize()})
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    site = web.TCPSite(runner, listen, port)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await site.start()
+        await application.bot.set_webhook(
+            url=webhook_url,
+            allowed_updates=allowed_updates,
+            secret_token=secret_token or None,
+            max_connections=max_connections,
+        )
+        await application.start()
+        logger.info(f"Webhook server listening on {listen}:{port}{path}")
+        try:
+            await stop.wait()
+        finally:
+            # Stop accepting first: anything acked after application.stop() would never be processed
+            await runner.cleanup()
+            await application.stop()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+
+
+def run_webhook(application: Application, **kwargs) -> None:
+    asyncio.run(serve_webhook(application, **kwargs))